@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-from datetime import datetime
+from datetime import datetime, timedelta
 import sys
 import os
 sys.path.append(os.path.dirname(__file__))
@@ -82,36 +82,17 @@ def show_network_alert():
     For assistance, contact ICT Support at extension 5050
     """)
 
-def load_data_from_redis():
-    name = 'attendance:logs'
-    logs = face_utils.load_logs(name=name)
-    cleaned_logs = []
-    for log in logs:
-        if isinstance(log, bytes):
-            log = log.decode('utf-8')
-        log = log.strip("b'")
-        parts = log.split('@')
-        if len(parts) >= 4:  # Updated to handle both old and new formats
-            # Extract name and role (first two parts)
-            file_name_role = parts[0]
-            role = parts[1]
-            timestamp = parts[-2]  # Second last part is timestamp
-            Clock_In_Out = parts[-1]  # Last part is action
-            
-            # Handle zone if present (parts[2] would be zone in new format)
-            zone = 'Lagos Zone 2'  # Default if not specified
-            if len(parts) == 5:  # New format with zone
-                zone = parts[2]
-            
-            file_no, name = file_name_role.split('.', 1)
-            cleaned_logs.append({
-                'File No.': file_no,
-                'Name': name,
-                'Role': role,
-                'Zone': zone,  # Added zone
-                'Timestamp': timestamp,
-                'Clock_In_Out': Clock_In_Out
-            })
+def load_data_from_redis(start, end):
+    # Only the per-day attendance streams between start and end are read
+    events = face_utils.load_attendance(start, end)
+    cleaned_logs = [{
+        'File No.': event['file_no'],
+        'Name': event['name'],
+        'Role': event['role'],
+        'Zone': event['zone'],
+        'Timestamp': event['timestamp'],
+        'Clock_In_Out': event['action']
+    } for event in events]
 
     if not cleaned_logs:
         return pd.DataFrame()
@@ -135,18 +116,34 @@ def main():
         st.stop()
 
     # Rest of the application for authorized users
+    first_date, last_date = face_utils.attendance_date_bounds()
+    if first_date is None:
+        st.warning("No attendance data found in Redis database")
+        st.stop()
+
+    # Sidebar filters
+    st.sidebar.header('Filter Options')
+
+    # The date range decides how much history is loaded; default to the last 30 days
+    date_range = st.sidebar.date_input(
+        'Select Date Range',
+        value=[max(first_date, last_date - timedelta(days=30)), last_date],
+        min_value=first_date,
+        max_value=last_date,
+        help="Select date range for analysis"
+    )
+    if len(date_range) != 2:
+        date_range = (date_range[0], date_range[0])
+
     with st.spinner('Loading attendance data from Redis...'):
-        df = load_data_from_redis()
+        df = load_data_from_redis(date_range[0], date_range[1])
 
     if df.empty:
-        st.warning("No attendance data found in Redis database")
+        st.warning("No attendance data found for the selected dates")
         st.stop()
 
     st.subheader('Attendance Visualization Dashboard')
 
-    # Sidebar filters
-    st.sidebar.header('Filter Options')
-    
     # Zone filter (add this first)
     available_zones = ['All Zones'] + sorted(df['Zone'].unique().tolist())
     selected_zone = st.sidebar.selectbox(
@@ -168,20 +165,8 @@ def main():
         help="Filter by staff roles"
     )
     
-    date_range = st.sidebar.date_input(
-        'Select Date Range',
-        value=[df['Date'].min(), df['Date'].max()],
-        min_value=df['Date'].min(),
-        max_value=df['Date'].max(),
-        help="Select date range for analysis"
-    )
-
     # Filter data
-    filtered_df = df[
-        (df['Role'].isin(selected_roles)) & 
-        (df['Date'] >= date_range[0]) & 
-        (df['Date'] <= date_range[1])
-    ]
+    filtered_df = df[df['Role'].isin(selected_roles)]
     
     # Apply zone filter if not 'All Zones'
     if selected_zone != 'All Zones':
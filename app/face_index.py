@@ -0,0 +1,286 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+def matrix_fingerprint(matrix):
+    """Stable hash of a gallery matrix, used to tell whether a saved index still fits"""
+    digest = hashlib.sha1()
+    digest.update(str(matrix.shape).encode())
+    if isinstance(matrix, QuantizedMatrix):
+        digest.update(np.ascontiguousarray(matrix.codes).tobytes())
+        if matrix.scales is not None:
+            digest.update(np.ascontiguousarray(matrix.scales).tobytes())
+    else:
+        digest.update(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+STORAGE_TYPES = ('float32', 'float16', 'int8')
+
+# Rows dequantized per block when scoring a compact matrix
+_BLOCK_ROWS = 4096
+
+
+def quantize_rows(rows, storage='float32'):
+    """Encode float32 rows for storage; returns (codes, scales).
+
+    float16 is a plain cast. int8 uses one float32 scale per row
+    (max |x| / 127), so any row keeps its full dynamic range.
+    """
+    rows = np.asarray(rows, dtype=np.float32)
+    if storage == 'float32':
+        return rows, None
+    if storage == 'float16':
+        return rows.astype(np.float16), None
+    if storage == 'int8':
+        scales = np.abs(rows).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(rows / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"Unknown storage type '{storage}', expected one of {STORAGE_TYPES}")
+
+
+class QuantizedMatrix:
+    """Read-only view of float16 or int8 gallery rows.
+
+    Scores are computed block by block straight from the compact codes, so
+    the full float32 matrix is never materialized during a search.
+    """
+
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def take(self, rows):
+        block = self.codes[rows].astype(np.float32)
+        if self.scales is not None:
+            block *= self.scales[rows][:, None]
+        return block
+
+    def dot(self, queries):
+        """(k, n) scores of L2-normalized queries against every row"""
+        n = self.codes.shape[0]
+        similar = np.empty((queries.shape[0], n), dtype=np.float32)
+        for start in range(0, n, _BLOCK_ROWS):
+            stop = min(start + _BLOCK_ROWS, n)
+            similar[:, start:stop] = queries @ self.codes[start:stop].astype(np.float32).T
+        if self.scales is not None:
+            similar *= self.scales[None, :]
+        return similar
+
+    def __array__(self, dtype=None, copy=None):
+        return self.take(slice(None)).astype(dtype or np.float32, copy=False)
+
+
+def dot_rows(matrix, queries):
+    if isinstance(matrix, QuantizedMatrix):
+        return matrix.dot(queries)
+    return queries @ matrix.T
+
+
+def take_rows(matrix, rows):
+    if isinstance(matrix, QuantizedMatrix):
+        return matrix.take(rows)
+    return matrix[rows]
+
+
+def _top1(scores, candidates):
+    best = int(np.argmax(scores))
+    return int(candidates[best]), float(scores[best])
+
+
+class FlatIndex:
+    """Exact brute-force cosine search over every gallery row"""
+    kind = 'flat'
+
+    def build(self, matrix):
+        # Nothing to precompute or persist
+        return self
+
+    def add(self, matrix, rows):
+        pass
+
+    def remove(self, row, last):
+        pass
+
+    def search(self, matrix, queries):
+        # queries are already L2-normalized (k, 512) rows
+        similar = dot_rows(matrix, queries)
+        best = np.argmax(similar, axis=1)
+        return best, similar[np.arange(best.shape[0]), best]
+
+
+class IVFIndex:
+    """Inverted-file index with a spherical k-means coarse quantizer.
+
+    Rows are bucketed under their nearest of `nlist` centroids; a query only
+    scans the rows of its `nprobe` closest buckets. Raising `nprobe` trades
+    latency for recall, and nprobe == nlist is an exact search.
+    """
+    kind = 'ivf'
+
+    def __init__(self, nlist=64, nprobe=8, niter=20, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.niter = niter
+        self.seed = seed
+        self.centroids = None
+        self.assignments = None
+        self.lists = []
+        self.fingerprint = None
+
+    def _train(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        rng = np.random.default_rng(self.seed)
+        nlist = max(1, min(self.nlist, matrix.shape[0]))
+        centroids = matrix[rng.choice(matrix.shape[0], nlist, replace=False)].copy()
+
+        for _ in range(self.niter):
+            assignments = np.argmax(matrix @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            order = np.argsort(assignments, kind='stable')
+            used, starts = np.unique(assignments[order], return_index=True)
+            sums[used] = np.add.reduceat(matrix[order], starts, axis=0)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            empty = norms[:, 0] == 0
+            # Re-seed empty buckets from random rows so every list gets used
+            if empty.any():
+                sums[empty] = matrix[rng.choice(matrix.shape[0], int(empty.sum()))]
+                norms[empty] = np.linalg.norm(sums[empty], axis=1, keepdims=True)
+            centroids = (sums / norms).astype(np.float32)
+
+        return np.ascontiguousarray(centroids)
+
+    def _fill_lists(self):
+        order = np.argsort(self.assignments, kind='stable')
+        counts = np.bincount(self.assignments, minlength=self.centroids.shape[0])
+        self.lists = np.split(order, np.cumsum(counts)[:-1])
+
+    def build(self, matrix):
+        self.fingerprint = matrix_fingerprint(matrix)
+        if matrix.shape[0] == 0:
+            self.centroids = np.empty((0, matrix.shape[1]), dtype=np.float32)
+            self.assignments = np.empty(0, dtype=np.int64)
+            self.lists = []
+            return self
+
+        self.centroids = self._train(matrix)
+        self.assignments = np.argmax(dot_rows(matrix, self.centroids), axis=0)
+        self._fill_lists()
+        return self
+
+    def add(self, matrix, rows):
+        """File new or changed gallery rows under their nearest centroid"""
+        if self.centroids is None or self.centroids.shape[0] == 0:
+            self.build(matrix)
+            return
+        rows = np.asarray(rows, dtype=np.int64)
+        targets = np.argmax(take_rows(matrix, rows) @ self.centroids.T, axis=1)
+        grow = int(rows.max()) + 1 - self.assignments.shape[0]
+        if grow > 0:
+            self.assignments = np.concatenate([self.assignments, np.full(grow, -1, dtype=np.int64)])
+        for row, target in zip(rows, targets):
+            current = self.assignments[row]
+            if current == target:
+                continue
+            if current >= 0:
+                self.lists[current] = self.lists[current][self.lists[current] != row]
+            self.lists[target] = np.append(self.lists[target], row)
+            self.assignments[row] = target
+        self.fingerprint = None
+
+    def remove(self, row, last):
+        """Forget `row`, whose slot now holds the former row `last`"""
+        current = self.assignments[row]
+        self.lists[current] = self.lists[current][self.lists[current] != row]
+        if row != last:
+            moved = self.assignments[last]
+            self.lists[moved][self.lists[moved] == last] = row
+            self.assignments[row] = moved
+        self.assignments = self.assignments[:last]
+        self.fingerprint = None
+
+    def search(self, matrix, queries):
+        k = queries.shape[0]
+        indices = np.zeros(k, dtype=np.int64)
+        scores = np.full(k, -1.0, dtype=np.float32)
+        if self.centroids is None or self.centroids.shape[0] == 0:
+            return indices, scores
+
+        nprobe = max(1, min(self.nprobe, self.centroids.shape[0]))
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        for i in range(k):
+            candidates = np.concatenate([self.lists[l] for l in probes[i]])
+            if candidates.shape[0] == 0:
+                continue
+            indices[i], scores[i] = _top1(take_rows(matrix, candidates) @ queries[i], candidates)
+        return indices, scores
+
+    def save(self, path):
+        np.savez(path, kind=self.kind, fingerprint=self.fingerprint,
+                 centroids=self.centroids, assignments=self.assignments,
+                 params=np.array([self.nlist, self.nprobe, self.niter, self.seed]))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        nlist, nprobe, niter, seed = (int(v) for v in arrays['params'])
+        index = cls(nlist=nlist, nprobe=nprobe, niter=niter, seed=seed)
+        index.fingerprint = str(arrays['fingerprint'])
+        index.centroids = arrays['centroids']
+        index.assignments = arrays['assignments']
+        index._fill_lists()
+        return index
+
+
+INDEX_TYPES = {
+    FlatIndex.kind: FlatIndex,
+    IVFIndex.kind: IVFIndex,
+}
+
+
+def make_index(kind='flat', **params):
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{kind}', expected one of {sorted(INDEX_TYPES)}")
+    return INDEX_TYPES[kind](**params)
+
+
+def load_index(path):
+    with np.load(path, allow_pickle=False) as arrays:
+        return INDEX_TYPES[str(arrays['kind'])].from_arrays(arrays)
+
+
+def load_or_build_index(matrix, kind='flat', path=None, **params):
+    """Reuse the index saved at `path` when it was built for this matrix with
+    the same build parameters, else build and save it"""
+    if kind == FlatIndex.kind:
+        return FlatIndex()
+
+    if path and os.path.exists(path):
+        try:
+            index = load_index(path)
+            # Build-time parameters (nlist, niter, seed) must match; nprobe may differ
+            built_with = all(getattr(index, key, value) == value for key, value in params.items() if key != 'nprobe')
+            if index.kind == kind and index.fingerprint == matrix_fingerprint(matrix) and built_with:
+                # Search-time knobs may change without a rebuild
+                if 'nprobe' in params and hasattr(index, 'nprobe'):
+                    index.nprobe = params['nprobe']
+                return index
+        except Exception as e:
+            print(f"Error loading index {path}: {str(e)}")
+
+    index = make_index(kind, **params).build(matrix)
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        index.save(path)
+    return index
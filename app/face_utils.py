@@ -3,12 +3,14 @@ import pandas as pd
 import redis
 import cv2
 import re
-import insightface
-from insightface.app import FaceAnalysis
-from sklearn.metrics import pairwise
-from sklearn.metrics.pairwise import cosine_similarity
 from datetime import datetime
 import os
+import time
+import threading
+import json
+import glob
+import queue
+import face_index
 
 # Connect to Redis Client
 import streamlit as st
@@ -19,58 +21,1331 @@ password = st.secrets["REDIS_PASSWORD"]
 
 r = redis.StrictRedis(host=hostname, port=portnumber, password=password)
 
-def retrive_data(name):
-    retrive_dict = r.hgetall(name)
-    retrive_series = pd.Series(retrive_dict)
-    retrive_series = retrive_series.apply(lambda x: np.frombuffer(x, dtype=np.float32))
-    index = retrive_series.index
-    index = list(map(lambda x: x.decode(), index))
-    retrive_series.index = index
-    retrive_df = retrive_series.to_frame().reset_index()
-    retrive_df.columns = ['ID_Name_Role', 'Facial_features']
-    
-    # Initialize default values
-    retrive_df['File No. Name'] = ''
-    retrive_df['Role'] = ''
-    retrive_df['Zone'] = 'Lagos Zone 2'  # Default zone
-    
-    # Process each record safely
-    for i, row in retrive_df.iterrows():
+# Gallery index: 'flat' (exact) or 'ivf' (approximate, tune FACE_INDEX_NPROBE for recall)
+index_kind = st.secrets.get("FACE_INDEX", "flat")
+index_params = {}
+if index_kind == 'ivf':
+    index_params = dict(nlist=int(st.secrets.get("FACE_INDEX_NLIST", 64)),
+                        nprobe=int(st.secrets.get("FACE_INDEX_NPROBE", 8)))
+index_dir = st.secrets.get("FACE_INDEX_DIR", "gallery_index")
+
+# Directory for memory-mapped gallery snapshots (empty to disable)
+snapshot_dir = st.secrets.get("GALLERY_SNAPSHOT_DIR", "gallery_snapshot")
+# Minimum seconds between snapshot rewrites after incremental refreshes
+snapshot_interval = float(st.secrets.get("GALLERY_SNAPSHOT_INTERVAL", 60))
+
+# Embedding storage: Redis write format and in-memory gallery format
+# ('float32', 'float16' or 'int8'); older float32 entries always load
+embedding_format = st.secrets.get("EMBEDDING_FORMAT", "float32")
+gallery_storage = st.secrets.get("GALLERY_STORAGE", "float32")
+
+# Fields fetched per HSCAN call when loading staff:register
+register_batch_size = int(st.secrets.get("REGISTER_SCAN_BATCH", 500))
+
+# Tracking mode: run detection every N processed frames and follow faces in between
+tracking_detect_every = int(st.secrets.get("TRACKING_DETECT_EVERY", 5))
+
+# Recognized names kept between attendance saves, and how many sightings
+# make a match count (filters one-frame false matches)
+log_max_identities = int(st.secrets.get("LOG_MAX_IDENTITIES", 64))
+log_min_hits = int(st.secrets.get("LOG_MIN_HITS", 3))
+
+# Zone whose gallery shard this kiosk searches first
+kiosk_zone = st.secrets.get("KIOSK_ZONE", "Lagos Zone 2")
+
+DEFAULT_ZONE = 'Lagos Zone 2'
+EMBEDDING_DIM = 512
+REGISTER_COLUMNS = ['ID_Name_Role', 'File No. Name', 'Role', 'Zone']
+
+def parse_register_key(key):
+    """Split a staff:register key `file.first.last@role[@zone]` into its labels"""
+    parts = key.split('@')
+    file_no, name = parts[0].split('.', 1)
+    return {
+        'ID_Name_Role': key,
+        'File No. Name': f"{file_no}.{name}",
+        'Role': parts[1] if len(parts) > 1 else '',
+        'Zone': parts[2] if len(parts) > 2 else DEFAULT_ZONE,
+    }
+
+def register_version_key(name):
+    return f"{name}:version"
+
+def register_changes_key(name):
+    return f"{name}:changes"
+
+def record_register_change(pipe, name, *fields):
+    """Queue a version bump for changed staff:register fields on a pipeline.
+
+    The changes sorted set keeps one member per field scored by the version
+    that last touched it, so readers can fetch only what changed since the
+    version they hold.
+    """
+    pipe.eval(
+        "local v = redis.call('INCR', KEYS[1]) "
+        "for i, f in ipairs(ARGV) do redis.call('ZADD', KEYS[2], v, f) end "
+        "return v",
+        2, register_version_key(name), register_changes_key(name), *fields)
+    return pipe
+
+# Tagged staff:register values; an untagged 2048-byte value is legacy float32
+FORMAT_TAGS = {'float16': b'EF16', 'int8': b'EI08'}
+TAG_FORMATS = {tag: fmt for fmt, tag in FORMAT_TAGS.items()}
+FORMAT_SIZES = {
+    'float32': EMBEDDING_DIM * 4,
+    'float16': 4 + EMBEDDING_DIM * 2,
+    'int8': 4 + 4 + EMBEDDING_DIM,
+}
+
+def encode_embedding(vector, fmt=None):
+    """Serialize one embedding for staff:register in the given storage format"""
+    fmt = fmt or embedding_format
+    vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+    if fmt == 'float32':
+        return vector.tobytes()
+    codes, scales = face_index.quantize_rows(vector, fmt)
+    payload = codes.tobytes() if scales is None else scales.tobytes() + codes.tobytes()
+    return FORMAT_TAGS[fmt] + payload
+
+def embedding_format_of(value):
+    if len(value) == FORMAT_SIZES['float32']:
+        return 'float32'
+    fmt = TAG_FORMATS.get(bytes(value[:4]))
+    return fmt if fmt and len(value) == FORMAT_SIZES[fmt] else None
+
+def _decode_block(fmt, values):
+    """Decode same-format values into a float32 (n, 512) block with one frombuffer"""
+    if fmt == 'float32':
+        return np.frombuffer(b''.join(values), dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    if fmt == 'float16':
+        block = np.frombuffer(b''.join(v[4:] for v in values), dtype=np.float16)
+        return block.reshape(-1, EMBEDDING_DIM).astype(np.float32)
+    raw = np.frombuffer(b''.join(v[4:] for v in values), dtype=np.uint8).reshape(-1, 4 + EMBEDDING_DIM)
+    scales = raw[:, :4].copy().view(np.float32)
+    return raw[:, 4:].view(np.int8).astype(np.float32) * scales
+
+def decode_embedding(value):
+    fmt = embedding_format_of(value)
+    if fmt is None:
+        raise ValueError(f"embedding has {len(value)} bytes")
+    return _decode_block(fmt, [value])[0]
+
+def parse_register(items):
+    """Decode staff:register (key, value) pairs into one (N, 512) block.
+
+    Embeddings of each storage format go through a single np.frombuffer over
+    the joined bytes, and keys are split in one pass over plain lists.
+    Returns the float32 matrix plus a dict of label lists parallel to its rows.
+    """
+    labels = {column: [] for column in REGISTER_COLUMNS}
+    groups = {}
+
+    for key, value in items:
+        key = key.decode() if isinstance(key, bytes) else key
+        fmt = embedding_format_of(value)
+        if fmt is None:
+            print(f"Error processing record {key}: embedding has {len(value)} bytes")
+            continue
         try:
-            parts = row['ID_Name_Role'].split('@')
-            
-            # Extract file no and name (first part before @)
-            file_name_role = parts[0]
-            file_no, name = file_name_role.split('.', 1)
-            
-            # Extract role (second part)
-            role = parts[1] if len(parts) > 1 else ''
-            
-            # Extract zone if available (third part in new format)
-            zone = parts[2] if len(parts) > 2 else 'Lagos Zone 2'
-            
-            # Update the row
-            retrive_df.at[i, 'File No. Name'] = f"{file_no}.{name}"
-            retrive_df.at[i, 'Role'] = role
-            retrive_df.at[i, 'Zone'] = zone
-            
+            parsed = parse_register_key(key)
         except Exception as e:
-            print(f"Error processing record {row['ID_Name_Role']}: {str(e)}")
-            continue
-    
+            print(f"Error processing record {key}: {str(e)}")
+            parsed = {'ID_Name_Role': key, 'File No. Name': '', 'Role': '', 'Zone': DEFAULT_ZONE}
+        rows, values = groups.setdefault(fmt, ([], []))
+        rows.append(len(labels['ID_Name_Role']))
+        values.append(value)
+        for column in REGISTER_COLUMNS:
+            labels[column].append(parsed[column])
+
+    if list(groups) in ([], ['float32']):
+        values = groups.get('float32', ([], []))[1]
+        matrix = np.frombuffer(b''.join(values), dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        return matrix, labels
+
+    # Mixed formats: one frombuffer per format, scattered back into key order
+    matrix = np.empty((len(labels['ID_Name_Role']), EMBEDDING_DIM), dtype=np.float32)
+    for fmt, (rows, values) in groups.items():
+        matrix[rows] = _decode_block(fmt, values)
+    return matrix, labels
+
+def scan_register(name, batch_size=500):
+    """Yield staff:register entries in HSCAN batches instead of one HGETALL reply"""
+    cursor = 0
+    while True:
+        cursor, chunk = r.hscan(name, cursor=cursor, count=batch_size)
+        if chunk:
+            yield chunk.items()
+        if cursor == 0:
+            break
+
+def load_register(name, batch_size=500):
+    """Stream the registry into a preallocated (N, 512) block chunk by chunk.
+
+    Peak client memory is the final block plus one HSCAN batch, and each
+    Redis call only walks `batch_size` fields.
+    """
+    capacity = max(int(r.hlen(name)), 1)
+    matrix = np.empty((capacity, EMBEDDING_DIM), dtype=np.float32)
+    labels = {column: [] for column in REGISTER_COLUMNS}
+    rows = {}
+
+    for items in scan_register(name, batch_size=batch_size):
+        chunk, chunk_labels = parse_register(items)
+        for i, key in enumerate(chunk_labels['ID_Name_Role']):
+            row = rows.get(key)
+            if row is None:
+                # HSCAN may return a field twice; registry may grow mid-scan
+                row = len(rows)
+                rows[key] = row
+                if row >= matrix.shape[0]:
+                    grown = np.empty((2 * matrix.shape[0], EMBEDDING_DIM), dtype=np.float32)
+                    grown[:row] = matrix[:row]
+                    matrix = grown
+                for column in REGISTER_COLUMNS:
+                    labels[column].append(chunk_labels[column][i])
+            matrix[row] = chunk[i]
+
+    return matrix[:len(rows)], labels
+
+def count_register(name, batch_size=500):
+    """Number of staff:register fields whose value parses as an embedding.
+
+    Walks the registry in the same HSCAN batches as load_register, so no
+    single Redis reply covers the whole hash; matches what parse_register keeps.
+    """
+    keys = set()
+    for items in scan_register(name, batch_size=batch_size):
+        # HSCAN may return a field twice
+        keys.update(key for key, value in items if embedding_format_of(value) is not None)
+    return len(keys)
+
+def retrive_data(name, batch_size=None):
+    matrix, labels = load_register(name, batch_size=batch_size or register_batch_size)
+    retrive_df = pd.DataFrame(labels)
+    # Rows of the shared block, so no per-row copies are made
+    retrive_df['Facial_features'] = list(matrix)
     return retrive_df[['ID_Name_Role', 'File No. Name', 'Role', 'Facial_features', 'Zone']]
 
 def load_logs(name, end=-1):
     logs_list = r.lrange(name, start=0, end=end)
     return logs_list
 
+# Last attendance action per staff: file number -> "action@timestamp", written
+# atomically with the attendance event
+ATTENDANCE_LOGS = 'attendance:logs'
+ATTENDANCE_STATE = 'attendance:last_action'
+
+# Attendance events live in one stream per day, attendance:YYYY-MM-DD, with
+# typed fields; attendance:days indexes the days that have a stream
+# (score YYYYMMDD) so readers only touch the partitions in their range
+ATTENDANCE_DAYS = 'attendance:days'
+
+# Keep appending name@role@timestamp@action strings to attendance:logs for
+# tools that still read the old list
+attendance_legacy_log = bool(st.secrets.get("ATTENDANCE_LEGACY_LOG", False))
+
+def attendance_stream_key(day):
+    return f"attendance:{day}"
+
+def _day_score(day):
+    return int(day.replace('-', ''))
+
+def staff_file_number(name):
+    """File number part of a `file.first.last` staff name"""
+    return name.split('.', 1)[0]
+
+def parse_log_time(timestamp):
+    return datetime.strptime(timestamp.split('.')[0], '%Y-%m-%d %H:%M:%S')
+
+def last_attendance_action(name):
+    """(action, datetime) of the staff member's last clock-in/out, or (None, None)"""
+    value = r.hget(ATTENDANCE_STATE, staff_file_number(name))
+    if value is None:
+        return None, None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    action, timestamp = value.split('@', 1)
+    try:
+        return action, parse_log_time(timestamp)
+    except ValueError:
+        return None, None
+
+def action_allowed(last_action, last_time, current_action, now=None):
+    """A repeat of the same action is blocked only on the same day"""
+    if last_action is None or last_time is None:
+        return True
+    if last_time.date() != (now or datetime.now()).date():
+        return True
+    return last_action != current_action
+
+# Check, state update and event append for a batch in one atomic call, so
+# two kiosks seeing the same officer cannot both record the action.
+# KEYS: state hash, legacy logs list, day stream, days index.
+# ARGV: action, today (YYYY-MM-DD), zone, legacy flag, then
+# (file number, name, role, timestamp, legacy entry) per staff.
+# Returns 1/0 per staff.
+_record_attendance_script = r.register_script("""
+local action, today, zone, legacy = ARGV[1], ARGV[2], ARGV[3], ARGV[4] == '1'
+local recorded = {}
+for i = 5, #ARGV, 5 do
+    local file_no, name, role, timestamp, entry = ARGV[i], ARGV[i + 1], ARGV[i + 2], ARGV[i + 3], ARGV[i + 4]
+    local last = redis.call('HGET', KEYS[1], file_no)
+    local blocked = false
+    if last then
+        local sep = string.find(last, '@', 1, true)
+        if sep and string.sub(last, 1, sep - 1) == action and string.sub(last, sep + 1, sep + 10) == today then
+            blocked = true
+        end
+    end
+    if blocked then
+        table.insert(recorded, 0)
+    else
+        redis.call('XADD', KEYS[3], '*', 'file_no', file_no, 'name', name, 'role', role,
+                   'zone', zone, 'timestamp', timestamp, 'action', action)
+        if legacy then
+            redis.call('LPUSH', KEYS[2], entry)
+        end
+        redis.call('HSET', KEYS[1], file_no, action .. '@' .. timestamp)
+        table.insert(recorded, 1)
+    end
+end
+if #recorded > 0 then
+    redis.call('ZADD', KEYS[4], tonumber((string.gsub(today, '-', ''))), today)
+end
+return recorded
+""")
+
+def record_attendance(entries, action, zone=None):
+    """Record (name, role, current_time) entries for one action in one round trip.
+
+    Staff whose last action today was the same action are skipped; returns
+    one bool per entry telling whether it was recorded.
+    """
+    if not entries:
+        return []
+    today = datetime.now().strftime('%Y-%m-%d')
+    args = [action, today, zone or kiosk_zone, '1' if attendance_legacy_log else '0']
+    for name, role, current_time in entries:
+        file_no = staff_file_number(name)
+        args += [file_no, name[len(file_no) + 1:], role, current_time, f"{name}@{role}@{current_time}@{action}"]
+    keys = [ATTENDANCE_STATE, ATTENDANCE_LOGS, attendance_stream_key(today), ATTENDANCE_DAYS]
+    recorded = _record_attendance_script(keys=keys, args=args)
+    return [bool(flag) for flag in recorded]
+
+def attendance_days(start=None, end=None):
+    """Days (YYYY-MM-DD) with attendance between the start and end dates, inclusive"""
+    low = _day_score(str(start)) if start else '-inf'
+    high = _day_score(str(end)) if end else '+inf'
+    return [day.decode('utf-8') if isinstance(day, bytes) else day
+            for day in r.zrangebyscore(ATTENDANCE_DAYS, low, high)]
+
+def attendance_date_bounds():
+    """(first, last) day with attendance as dates, or (None, None)"""
+    first = r.zrange(ATTENDANCE_DAYS, 0, 0)
+    last = r.zrange(ATTENDANCE_DAYS, -1, -1)
+    if not first:
+        return None, None
+    to_date = lambda day: datetime.strptime(day.decode('utf-8') if isinstance(day, bytes) else day, '%Y-%m-%d').date()
+    return to_date(first[0]), to_date(last[0])
+
+def load_attendance(start=None, end=None):
+    """Attendance events between two dates (inclusive) as a list of dicts.
+
+    Only the day streams inside the range are read, all in one pipeline.
+    """
+    days = attendance_days(start, end)
+    if not days:
+        return []
+    pipe = r.pipeline(transaction=False)
+    for day in days:
+        pipe.xrange(attendance_stream_key(day))
+    events = []
+    for entries in pipe.execute():
+        for _, fields in entries:
+            events.append({key.decode('utf-8'): value.decode('utf-8') for key, value in fields.items()})
+    return events
+
+def migrate_attendance_logs(batch_size=1000):
+    """One-time copy of the attendance:logs list into the per-day streams.
+
+    The list is read in batches, oldest entries first, and left in place.
+    Entries already in their day's stream (copied by an earlier run, or
+    written to both by record_attendance with ATTENDANCE_LEGACY_LOG on) are
+    skipped, so running it again never duplicates events.
+    """
+    seen = {}
+    total = r.llen(ATTENDANCE_LOGS)
+    copied = 0
+    # LPUSH puts new entries at the head, so the oldest are at the tail
+    for stop in range(total - 1, -1, -batch_size):
+        start = max(0, stop - batch_size + 1)
+        pipe = r.pipeline(transaction=False)
+        for log in reversed(r.lrange(ATTENDANCE_LOGS, start, stop)):
+            if isinstance(log, bytes):
+                log = log.decode('utf-8')
+            parts = log.strip("b'").split('@')
+            if len(parts) < 4:
+                continue
+            name, role, timestamp, action = parts[0], parts[1], parts[-2], parts[-1]
+            zone = parts[2] if len(parts) == 5 else DEFAULT_ZONE
+            try:
+                day = parse_log_time(timestamp).strftime('%Y-%m-%d')
+            except ValueError:
+                continue
+            file_no = staff_file_number(name)
+            if day not in seen:
+                seen[day] = {(fields.get(b'file_no', b'').decode('utf-8'),
+                              fields.get(b'timestamp', b'').decode('utf-8'),
+                              fields.get(b'action', b'').decode('utf-8'))
+                             for _, fields in r.xrange(attendance_stream_key(day))}
+            key = (file_no, timestamp, action)
+            if key in seen[day]:
+                continue
+            seen[day].add(key)
+            pipe.xadd(attendance_stream_key(day), dict(file_no=file_no, name=name[len(file_no) + 1:], role=role,
+                                                       zone=zone, timestamp=timestamp, action=action))
+            pipe.zadd(ATTENDANCE_DAYS, {day: _day_score(day)})
+            copied += 1
+        pipe.execute()
+
+    return f"Migrated {copied} attendance entries"
+
+# Backfill writes: a field is only set when the list entry is newer than the
+# stored action, so state written by record_attendance is never rolled back.
+# KEYS: state hash. ARGV: (file number, YYYY-MM-DD HH:MM:SS, action@timestamp)
+# per staff. Returns the number of fields written.
+_backfill_attendance_script = r.register_script("""
+local written = 0
+for i = 1, #ARGV, 3 do
+  local current = redis.call('HGET', KEYS[1], ARGV[i])
+  if not current or string.sub(string.match(current, '@(.*)$') or '', 1, 19) < ARGV[i + 1] then
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+    written = written + 1
+  end
+end
+return written
+""")
+
+def rebuild_attendance_state(batch_size=1000):
+    """Backfill attendance:last_action from the attendance:logs list.
+
+    Needed once for logs written before the state hash existed (see
+    ensure_attendance_state). The list is read in batches and the newest
+    entry per staff member is kept; it only replaces a stored action that
+    is older, so running it after rollout is safe.
+    """
+    latest = {}
+    for start in range(0, r.llen(ATTENDANCE_LOGS), batch_size):
+        for log in r.lrange(ATTENDANCE_LOGS, start, start + batch_size - 1):
+            if isinstance(log, bytes):
+                log = log.decode('utf-8')
+            parts = log.split('@')
+            if len(parts) not in (4, 5):
+                continue
+            name, timestamp, action = parts[0], parts[-2], parts[-1]
+            file_no = staff_file_number(name)
+            try:
+                log_time = parse_log_time(timestamp)
+            except ValueError:
+                continue
+            if file_no not in latest or log_time > latest[file_no][0]:
+                latest[file_no] = (log_time, f"{action}@{timestamp}")
+
+    written = 0
+    items = list(latest.items())
+    for start in range(0, len(items), batch_size):
+        args = []
+        for file_no, (log_time, value) in items[start:start + batch_size]:
+            args += [file_no, log_time.strftime('%Y-%m-%d %H:%M:%S'), value]
+        written += int(_backfill_attendance_script(keys=[ATTENDANCE_STATE], args=args))
+    return f"Rebuilt last action for {written} staff"
+
+@st.cache_resource
+def ensure_attendance_state():
+    """Run rebuild_attendance_state once per deployment; the Clock pages call this
+    so the same-day repeat check covers actions recorded before the state hash"""
+    marker = f"{ATTENDANCE_STATE}:rebuilt"
+    if not r.set(marker, 1, nx=True):
+        return None
+    try:
+        return rebuild_attendance_state()
+    except Exception as e:
+        r.delete(marker)
+        print(f"Error rebuilding attendance state: {str(e)}")
+        return None
+
 # configure face analysis
-faceapp = FaceAnalysis(name='buffalo_sc',
-                     root='insightface_model',
-                     providers=['CPUExecutionProvider'])
-faceapp.prepare(ctx_id=0, det_size=(640, 640), det_thresh=0.5)
+model_root = st.secrets.get("MODEL_ROOT", "insightface_model")
+model_name = st.secrets.get("MODEL_NAME", "buffalo_sc")
+det_size_default = int(st.secrets.get("DET_SIZE", 640))
+
+# ONNX Runtime session defaults (0 threads lets ONNX Runtime decide)
+session_defaults = dict(
+    intra_op_threads=int(st.secrets.get("ORT_INTRA_OP_THREADS", 0)),
+    inter_op_threads=int(st.secrets.get("ORT_INTER_OP_THREADS", 0)),
+    graph_optimization=st.secrets.get("ORT_GRAPH_OPTIMIZATION", "all"),
+    execution_mode=st.secrets.get("ORT_EXECUTION_MODE", "sequential"),
+)
+
+# Cross-session batching of the recognition model: max crops per ONNX call,
+# and how long the first crop waits for others (1 disables batching)
+embed_batch_size = int(st.secrets.get("EMBED_BATCH_SIZE", 32))
+embed_batch_wait = float(st.secrets.get("EMBED_BATCH_WAIT_MS", 5)) / 1000.0
+
+# Most embeddings averaged for Staff Movement / Duty Report verification;
+# caps VERIFY_TOP_K below
+verify_samples = int(st.secrets.get("VERIFY_SAMPLES", 64))
+
+# Face samples averaged into a template: the best REGISTER_SAMPLES (enrolment)
+# or VERIFY_TOP_K (verification, at most VERIFY_SAMPLES) faces of at least
+# QUALITY_MIN are kept, and capture stops once all of them reach
+# QUALITY_TARGET (see face_quality)
+register_samples = int(st.secrets.get("REGISTER_SAMPLES", 20))
+verify_top_k = int(st.secrets.get("VERIFY_TOP_K", 10))
+quality_min = float(st.secrets.get("QUALITY_MIN", 0.5))
+quality_target = float(st.secrets.get("QUALITY_TARGET", 0.7))
+
+# Draw boxes and names on the returned video; off sends camera frames back untouched
+annotate_frames = bool(st.secrets.get("ANNOTATE_FRAMES", True))
+
+# Detection runs on frames downscaled to this width (0 keeps the camera
+# resolution); faces smaller than MIN_FACE_SIZE pixels are not embedded
+infer_width_default = int(st.secrets.get("INFERENCE_WIDTH", 640))
+min_face_size_default = int(st.secrets.get("MIN_FACE_SIZE", 24))
+
+# Unix socket of the shared inference server (inference_server.py); empty runs the models in-process
+inference_socket = st.secrets.get("INFERENCE_SOCKET", "")
+# Shared secret both ends of the inference socket must present
+inference_authkey = st.secrets.get("INFERENCE_AUTHKEY", "")
+
+# insightface, onnxruntime and sklearn are imported on first use, so pages
+# that never run inference (e.g. the Home dashboard) do not pay for them
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+EXECUTION_MODES = {
+    'sequential': 'ORT_SEQUENTIAL',
+    'parallel': 'ORT_PARALLEL',
+}
+
+def make_session_options(intra_op_threads=0, inter_op_threads=0, graph_optimization='all', execution_mode='sequential'):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, GRAPH_OPTIMIZATION_LEVELS[graph_optimization])
+    options.execution_mode = getattr(ort.ExecutionMode, EXECUTION_MODES[execution_mode])
+    return options
+
+def _model_file(prefix_match):
+    from insightface.utils.storage import ensure_available
+
+    model_dir = ensure_available('models', model_name, root=model_root)
+    for path in sorted(glob.glob(os.path.join(model_dir, '*.onnx'))):
+        if os.path.basename(path).startswith('det_') == prefix_match:
+            return path
+    raise FileNotFoundError(f"No {'detection' if prefix_match else 'recognition'} model in {model_dir}")
+
+def _load_model(path, session_options):
+    from insightface.model_zoo.model_zoo import ModelRouter
+
+    options = make_session_options(**{**session_defaults, **(session_options or {})})
+    # ModelRouter forwards sess_options to the InferenceSession; model_zoo.get_model does not
+    return ModelRouter(path).get_model(providers=['CPUExecutionProvider'], sess_options=options)
+
+class FaceDetector:
+    """SCRFD detection stage with its own input size and ONNX Runtime session"""
+    def __init__(self, det_size=(640, 640), det_thresh=0.5, session_options=None):
+        self.det_size = tuple(det_size)
+        self.model = _load_model(_model_file(True), session_options)
+        self.model.prepare(ctx_id=0, input_size=self.det_size, det_thresh=det_thresh)
+
+    def __call__(self, image):
+        """Returns Face objects with bbox, kps and det_score but no embedding"""
+        from insightface.app.common import Face
+
+        bboxes, kpss = self.model.detect(image, max_num=0, metric='default')
+        faces = []
+        for i in range(bboxes.shape[0]):
+            kps = kpss[i] if kpss is not None else None
+            faces.append(Face(bbox=bboxes[i, 0:4], kps=kps, det_score=bboxes[i, 4]))
+        return faces
+
+class EmbeddingBatcher:
+    """Coalesces aligned face crops from concurrent callers into one model call.
+
+    The first waiting request opens a batch; crops submitted by other
+    sessions within `max_wait` seconds join it, up to `max_batch` crops,
+    and the whole batch runs as a single ONNX call on a worker thread.
+    A lone caller pays at most `max_wait` of extra latency.
+    """
+    def __init__(self, run, max_batch=32, max_wait=0.005):
+        self.run = run
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        # Request that did not fit the previous batch; opens the next one
+        self._carry = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def __call__(self, crops):
+        request = dict(crops=crops, done=threading.Event(), result=None, error=None)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._serve, daemon=True)
+                self._thread.start()
+        self._queue.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def _collect(self):
+        # A single request larger than max_batch still runs, on its own
+        request, self._carry = self._carry, None
+        batch = [request if request is not None else self._queue.get()]
+        size = len(batch[0]['crops'])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(request['crops']) > self.max_batch:
+                self._carry = request
+                break
+            batch.append(request)
+            size += len(request['crops'])
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._collect()
+            try:
+                features = self.run([crop for request in batch for crop in request['crops']])
+                start = 0
+                for request in batch:
+                    stop = start + len(request['crops'])
+                    request['result'] = features[start:stop]
+                    start = stop
+            except Exception as e:
+                print(f"Error running embedding batch: {str(e)}")
+                for request in batch:
+                    request['error'] = e
+            for request in batch:
+                request['done'].set()
+
+class FaceEmbedder:
+    """ArcFace recognition stage; its 112x112 input is fixed by the model.
+
+    Faces are aligned on the calling thread; the crops then go through the
+    shared EmbeddingBatcher unless batching is turned off.
+    """
+    def __init__(self, session_options=None, max_batch=None, max_wait=None):
+        self.model = _load_model(_model_file(False), session_options)
+        self.model.prepare(ctx_id=0)
+        max_batch = embed_batch_size if max_batch is None else max_batch
+        max_wait = embed_batch_wait if max_wait is None else max_wait
+        self.batcher = EmbeddingBatcher(self.model.get_feat, max_batch, max_wait) if max_batch > 1 else None
+
+    def __call__(self, image, faces):
+        from insightface.utils import face_align
+
+        if not faces:
+            return faces
+        crops = [face_align.norm_crop(image, landmark=face.kps, image_size=self.model.input_size[0]) for face in faces]
+        for face, feature in zip(faces, self.embed_crops(crops)):
+            face.embedding = feature.flatten()
+        return faces
+
+    def embed_crops(self, crops):
+        """Features for crops already aligned to the model input"""
+        return self.batcher(crops) if self.batcher is not None else self.model.get_feat(crops)
+
+_model_cache = {}
+_model_cache_lock = threading.Lock()
+# Model configurations already warmed up in this process
+_warmed_models = set()
+
+def _cached_model(key, build):
+    # Built once per process on first use; concurrent first users wait for one build
+    with _model_cache_lock:
+        if key not in _model_cache:
+            _model_cache[key] = build()
+        return _model_cache[key]
+
+def _options_key(session_options):
+    return tuple(sorted({**session_defaults, **(session_options or {})}.items()))
+
+def resize_for_inference(image, width, out=None):
+    """Returns (image, scale) with image at most `width` pixels wide.
+
+    `scale` maps coordinates on the returned image back to the original.
+    Frames that are already small enough (or width 0) are returned as is;
+    otherwise `out` is reused as the destination when its shape fits.
+    """
+    h, w = image.shape[:2]
+    if not width or w <= width:
+        return image, 1.0
+    size = (width, max(1, int(round(h * width / w))))
+    if out is None or out.shape[:2] != (size[1], size[0]):
+        out = None
+    small = cv2.resize(image, size, dst=out, interpolation=cv2.INTER_LINEAR)
+    return small, w / size[0]
+
+class FaceModels:
+    """Detection plus recognition with the FaceAnalysis.get interface.
+
+    The ONNX sessions are created lazily on first access and cached per
+    process, and shared by every FaceModels with the same configuration.
+    """
+    def __init__(self, det_size=None, det_thresh=0.5, detector_options=None, embedder_options=None,
+                 infer_width=None, min_face_size=None):
+        self.det_size = tuple(det_size or (det_size_default, det_size_default))
+        self.det_thresh = det_thresh
+        self.detector_options = detector_options
+        self.embedder_options = embedder_options
+        self.infer_width = infer_width_default if infer_width is None else infer_width
+        self.min_face_size = min_face_size_default if min_face_size is None else min_face_size
+        # Per-thread resize buffers, reused while the camera resolution stays the same
+        self._buffers = threading.local()
+
+    @property
+    def detector(self):
+        key = ('det', self.det_size, self.det_thresh, _options_key(self.detector_options))
+        return _cached_model(key, lambda: FaceDetector(self.det_size, self.det_thresh, self.detector_options))
+
+    @property
+    def embedder(self):
+        key = ('rec', _options_key(self.embedder_options))
+        return _cached_model(key, lambda: FaceEmbedder(self.embedder_options))
+
+    def detect(self, image):
+        """Detect on a copy downscaled to `infer_width`; boxes and keypoints are mapped
+        back to `image` coordinates and faces smaller than `min_face_size` are dropped"""
+        small, scale = resize_for_inference(image, self.infer_width, getattr(self._buffers, 'image', None))
+        if small is not image:
+            self._buffers.image = small
+        faces = self.detector(small)
+        kept = []
+        for face in faces:
+            if scale != 1.0:
+                face.bbox = face.bbox * scale
+                if face.kps is not None:
+                    face.kps = face.kps * scale
+            x1, y1, x2, y2 = face.bbox
+            if min(x2 - x1, y2 - y1) >= self.min_face_size:
+                kept.append(face)
+        return kept
+
+    def get(self, image):
+        # Crops for recognition come from the full-resolution image
+        return self.embedder(image, self.detect(image))
+
+    def warm_up(self, background=True):
+        """Load both sessions and run one dummy inference, optionally on a background thread.
+
+        Runs once per process and configuration; later calls (e.g. page reruns)
+        return None straight away.
+        """
+        key = (self.det_size, self.det_thresh, _options_key(self.detector_options),
+               _options_key(self.embedder_options))
+        with _model_cache_lock:
+            if key in _warmed_models:
+                return None
+            _warmed_models.add(key)
+
+        def run():
+            try:
+                from insightface.app.common import Face
+                from insightface.utils.face_align import arcface_dst
+
+                image = np.zeros((self.det_size[1], self.det_size[0], 3), dtype=np.uint8)
+                self.detector(image)
+                face = Face(bbox=np.array([0, 0, 112, 112], dtype=np.float32), kps=arcface_dst.copy(), det_score=1.0)
+                self.embedder(image, [face])
+            except Exception as e:
+                print(f"Error warming up face models: {str(e)}")
+
+        if not background:
+            run()
+            return None
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+def load_face_models(det_size=None, det_thresh=0.5, detector_options=None, embedder_options=None,
+                     infer_width=None, min_face_size=None, local=False):
+    """Face models for one page configuration.
+
+    Nothing is loaded until the models are first used. Sessions are shared
+    across pages that ask for the same configuration, e.g. a kiosk page can
+    use a 320x320 detector while sharing the recognition session with
+    every other page.
+
+    When INFERENCE_SOCKET is set (and `local` is False) the models run in the
+    inference server's worker processes instead, with the in-process models
+    as the fallback while the server is unreachable.
+    """
+    models = FaceModels(det_size, det_thresh, detector_options, embedder_options, infer_width, min_face_size)
+    if local or not inference_socket:
+        return models
+    if not inference_authkey:
+        print("Error using inference server: INFERENCE_AUTHKEY is not set, running models in-process")
+        return models
+
+    from inference_server import RemoteFaceModels
+    return RemoteFaceModels(inference_socket, inference_authkey, det_size=det_size, det_thresh=det_thresh,
+                            detector_options=detector_options, embedder_options=embedder_options,
+                            infer_width=models.infer_width, min_face_size=models.min_face_size,
+                            fallback=models)
+
+# Default models; cheap to create, sessions load on first use
+faceapp = load_face_models()
+
+def detect_faces(image, models=None):
+    """Run only the detection stage; returns Face objects without embeddings"""
+    return (models or faceapp).detect(image)
+
+def embed_faces(image, faces, models=None):
+    """Run only the recognition model on already-detected faces"""
+    return (models or faceapp).embedder(image, faces)
+
+def _normalize_rows(features):
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(features / norms, dtype=np.float32)
+
+class FaceGallery:
+    """Preloaded staff gallery for matching.
+
+    Holds a C-contiguous, L2-normalized (N, 512) matrix plus label arrays
+    parallel to its rows, so a lookup is one dot product and an argmax
+    instead of a DataFrame scan. Rows are kept as float32, or as float16 /
+    per-row-scaled int8 codes when `storage` asks for a compact gallery.
+    """
+    def __init__(self, features, labels, index=None, normalized=False, storage=None, scales=None):
+        self.storage = storage or gallery_storage
+        features = np.asarray(features)
+        if normalized and features.dtype == np.dtype(self.storage):
+            # Already-encoded rows (e.g. a memory-mapped snapshot) are used as-is, without a copy
+            self._buffer = features.reshape(-1, EMBEDDING_DIM)
+            self._scales = scales
+        else:
+            rows = features.astype(np.float32, copy=False).reshape(-1, EMBEDDING_DIM)
+            if not normalized:
+                rows = _normalize_rows(rows)
+            self._buffer, self._scales = face_index.quantize_rows(rows, self.storage)
+        self._label_buffers = {column: np.asarray(values, dtype=object) for column, values in labels.items()}
+        self._size = self._buffer.shape[0]
+        self._rows = None
+        # Guards searches against in-place refreshes from GalleryCache
+        self._lock = threading.RLock()
+        self.index = index if index is not None else face_index.FlatIndex().build(self.matrix)
+
+    @property
+    def matrix(self):
+        if self.storage == 'float32':
+            return self._buffer[:self._size]
+        scales = None if self._scales is None else self._scales[:self._size]
+        return face_index.QuantizedMatrix(self._buffer[:self._size], scales)
+
+    @property
+    def labels(self):
+        return {column: values[:self._size] for column, values in self._label_buffers.items()}
+
+    def set_index(self, kind='flat', path=None, **params):
+        """Swap the search structure behind the gallery (see face_index)"""
+        self.index = face_index.load_or_build_index(self.matrix, kind=kind, path=path, **params)
+        return self
+
+    def _row_of(self, key):
+        if self._rows is None:
+            keys = self._label_buffers['ID_Name_Role'][:self._size]
+            self._rows = {k: i for i, k in enumerate(keys)}
+        return self._rows.get(key)
+
+    def _reserve(self, size):
+        # Grow the backing arrays geometrically so appends stay amortized O(1)
+        capacity = self._buffer.shape[0]
+        if size <= capacity:
+            if not self._buffer.flags.writeable:
+                # Copy-on-write for read-only snapshot pages
+                self._buffer = np.array(self._buffer)
+                if self._scales is not None:
+                    self._scales = np.array(self._scales)
+            return
+        capacity = max(size, 2 * capacity, 16)
+        buffer = np.zeros((capacity, EMBEDDING_DIM), dtype=self._buffer.dtype)
+        buffer[:self._size] = self._buffer[:self._size]
+        self._buffer = buffer
+        if self._scales is not None:
+            scales = np.ones(capacity, dtype=np.float32)
+            scales[:self._size] = self._scales[:self._size]
+            self._scales = scales
+        for column, values in self._label_buffers.items():
+            grown = np.empty(capacity, dtype=object)
+            grown[:self._size] = values[:self._size]
+            self._label_buffers[column] = grown
+
+    def upsert(self, key, vector, labels):
+        """Insert or overwrite the row for `key`; labels must include every label column"""
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        if vector.shape[0] != EMBEDDING_DIM:
+            return False
+        with self._lock:
+            return self._upsert(key, vector, labels)
+
+    def _upsert(self, key, vector, labels):
+        row = self._row_of(key)
+        if row is None:
+            row = self._size
+            self._reserve(row + 1)
+            self._size += 1
+            self._rows[key] = row
+        else:
+            self._reserve(self._size)
+        codes, scales = face_index.quantize_rows(_normalize_rows(vector.reshape(1, -1)), self.storage)
+        self._buffer[row] = codes[0]
+        if scales is not None:
+            self._scales[row] = scales[0]
+        for column, values in self._label_buffers.items():
+            values[row] = key if column == 'ID_Name_Role' else labels[column]
+        self.index.add(self.matrix, [row])
+        return True
+
+    def remove(self, key):
+        """Drop the row for `key` by moving the last row into its slot"""
+        with self._lock:
+            return self._remove(key)
+
+    def _remove(self, key):
+        row = self._row_of(key)
+        if row is None:
+            return False
+        last = self._size - 1
+        if row != last:
+            self._reserve(self._size)
+            self._buffer[row] = self._buffer[last]
+            if self._scales is not None:
+                self._scales[row] = self._scales[last]
+            for values in self._label_buffers.values():
+                values[row] = values[last]
+            self._rows[self._label_buffers['ID_Name_Role'][row]] = row
+        del self._rows[key]
+        self._size = last
+        self.index.remove(row, last)
+        return True
+
+    @classmethod
+    def from_dataframe(cls, dataframe, feature_column='Facial_features'):
+        # Keep only rows holding a proper 512-d embedding
+        features = []
+        rows = []
+        for i, item in enumerate(dataframe[feature_column].tolist()):
+            if isinstance(item, (list, np.ndarray)) and np.size(item) == EMBEDDING_DIM:
+                features.append(np.asarray(item, dtype=np.float32).ravel())
+                rows.append(i)
+
+        label_columns = [c for c in dataframe.columns if c != feature_column]
+        subset = dataframe.iloc[rows]
+        labels = {column: subset[column].tolist() for column in label_columns}
+        if not features:
+            return cls(np.empty((0, EMBEDDING_DIM), dtype=np.float32), labels)
+        return cls(np.stack(features), labels)
+
+    @classmethod
+    def from_register(cls, matrix, labels):
+        return cls(matrix, labels)
+
+    def __len__(self):
+        return self._size
+
+    def search_batch(self, queries):
+        """Top-1 match for each row of a (k, 512) query matrix in one GEMM.
+
+        Returns (indices, scores); rows that cannot be matched get -1 and -1.0.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        k = queries.shape[0]
+        indices = np.full(k, -1, dtype=np.int64)
+        scores = np.full(k, -1.0, dtype=np.float32)
+        if len(self) == 0 or k == 0:
+            return indices, scores
+
+        norms = np.linalg.norm(queries, axis=1)
+        valid = norms > 0
+        if not valid.any():
+            return indices, scores
+        normalized = queries[valid] / norms[valid, None]
+        with self._lock:
+            best, best_scores = self.index.search(self.matrix, normalized)
+        indices[valid] = best
+        scores[valid] = best_scores
+        # Approximate indexes may find no candidate for a query
+        indices[scores < -0.5] = -1
+        return indices, scores
+
+    def search(self, test_vector):
+        """Return (row index, cosine score) of the best match, or (-1, -1.0)"""
+        test_vector = np.asarray(test_vector, dtype=np.float32).ravel()
+        if test_vector.shape[0] != EMBEDDING_DIM:
+            return -1, -1.0
+        indices, scores = self.search_batch(test_vector)
+        return int(indices[0]), float(scores[0])
+
+    def lookup(self, index, name_role=['File No. Name', 'Role']):
+        with self._lock:
+            return tuple(self._label_buffers[column][index] for column in name_role[:2])
+
+    def match_batch(self, queries, name_role=['File No. Name', 'Role'], thresh=0.5):
+        """Return a list of (name, role) per query plus the top-1 scores"""
+        matches = []
+        with self._lock:
+            indices, scores = self.search_batch(queries)
+            for best, score in zip(indices, scores):
+                if best < 0 or score < thresh:
+                    matches.append(('Unknown', 'Unknown'))
+                else:
+                    matches.append(self.lookup(best, name_role))
+        return matches, scores
+
+    def match(self, test_vector, name_role=['File No. Name', 'Role'], thresh=0.5):
+        with self._lock:
+            best, score = self.search(test_vector)
+            if best < 0 or score < thresh:
+                return 'Unknown', 'Unknown'
+            return self.lookup(best, name_role)
+
+class ShardedGallery:
+    """Gallery split into one FaceGallery shard per zone.
+
+    A kiosk searches its home zone first and only falls back to the other
+    shards for faces whose best home score is under the threshold.
+    """
+    def __init__(self, shards, home_zone=None):
+        self.shards = dict(shards)
+        self.home_zone = home_zone
+
+    @classmethod
+    def from_dataframe(cls, dataframe, feature_column='Facial_features', home_zone=None):
+        shards = {zone: FaceGallery.from_dataframe(group.reset_index(drop=True), feature_column)
+                  for zone, group in dataframe.groupby('Zone', sort=False)}
+        return cls(shards, home_zone=home_zone)
+
+    @classmethod
+    def from_register(cls, matrix, labels, home_zone=None):
+        zones = np.asarray(labels['Zone'], dtype=object)
+        shards = {}
+        for zone in dict.fromkeys(labels['Zone']):
+            rows = np.flatnonzero(zones == zone)
+            shard_labels = {column: np.asarray(values, dtype=object)[rows] for column, values in labels.items()}
+            shards[zone] = FaceGallery(matrix[rows], shard_labels)
+        return cls(shards, home_zone=home_zone)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards.values())
+
+    def set_shard(self, zone, gallery):
+        """Replace (or add) one zone's shard without touching the others"""
+        self.shards[zone] = gallery
+
+    def upsert(self, key, vector, labels):
+        zone = labels['Zone']
+        if zone not in self.shards:
+            self.shards[zone] = FaceGallery(np.empty((0, EMBEDDING_DIM), dtype=np.float32),
+                                            {column: [] for column in REGISTER_COLUMNS})
+        return self.shards[zone].upsert(key, vector, labels)
+
+    def remove(self, key):
+        return any(shard.remove(key) for shard in self.shards.values())
+
+    def match_batch(self, queries, name_role=['File No. Name', 'Role'], thresh=0.5, zone=None):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        zone = zone or self.home_zone
+        matches = [('Unknown', 'Unknown')] * queries.shape[0]
+        scores = np.full(queries.shape[0], -1.0, dtype=np.float32)
+
+        order = sorted(self.shards, key=lambda z: z != zone)
+        for shard_zone in order:
+            pending = np.flatnonzero(scores < thresh)
+            if pending.shape[0] == 0:
+                break
+            shard = self.shards[shard_zone]
+            with shard._lock:
+                indices, shard_scores = shard.search_batch(queries[pending])
+                for row, best, score in zip(pending, indices, shard_scores):
+                    if best >= 0 and score > scores[row]:
+                        scores[row] = score
+                        if score >= thresh:
+                            matches[row] = shard.lookup(best, name_role)
+        return matches, scores
+
+    def match(self, test_vector, name_role=['File No. Name', 'Role'], thresh=0.5, zone=None):
+        matches, _ = self.match_batch(test_vector, name_role=name_role, thresh=thresh, zone=zone)
+        return matches[0]
+
+def _index_gallery(gallery, name, kind=None, **params):
+    kind = kind or index_kind
+    params = params or index_params
+    if kind != 'flat':
+        # Persist the index so page loads reuse it until the registry changes
+        slug = re.sub(r'[^0-9A-Za-z]+', '_', name)
+        path = os.path.join(index_dir, f"{slug}.{kind}.npz")
+        gallery.set_index(kind, path=path, **params)
+    return gallery
+
+def load_gallery(name='staff:register', kind=None, **params):
+    gallery = FaceGallery.from_register(*load_register(name, batch_size=register_batch_size))
+    return _index_gallery(gallery, name, kind, **params)
+
+def load_sharded_gallery(name='staff:register', home_zone=None, kind=None, **params):
+    """Load the registry as per-zone shards, each with its own saved index"""
+    matrix, labels = load_register(name, batch_size=register_batch_size)
+    gallery = ShardedGallery.from_register(matrix, labels, home_zone=home_zone or kiosk_zone)
+    for zone, shard in gallery.shards.items():
+        _index_gallery(shard, f"{name}@{zone}", kind, **params)
+    return gallery
+
+def _snapshot_base(name, directory):
+    return os.path.join(directory, re.sub(r'[^0-9A-Za-z]+', '_', name))
+
+def save_snapshot(gallery, name='staff:register', version=0, directory=None, keep_newer=False):
+    """Write a sharded gallery as a versioned raw matrix plus a JSON sidecar.
+
+    Shards are laid out back to back in their storage dtype (int8 galleries
+    also get a float32 `.scales` file); the sidecar holds each zone's row
+    offset and the label lists. The sidecar is renamed into place last, so
+    a snapshot is only picked up once it is complete. Other versions are
+    removed afterwards, except newer ones when `keep_newer` is set.
+    """
+    directory = directory or snapshot_dir
+    os.makedirs(directory, exist_ok=True)
+    base = f"{_snapshot_base(name, directory)}.v{version}"
+    # Several processes may write the same version at once
+    tmp = f".{os.getpid()}.tmp"
+
+    zones = []
+    labels = {column: [] for column in REGISTER_COLUMNS}
+    offset = 0
+    storage = gallery_storage
+    with open(base + '.bin' + tmp, 'wb') as f, open(base + '.scales' + tmp, 'wb') as fs:
+        for zone, shard in gallery.shards.items():
+            with shard._lock:
+                storage = shard.storage
+                count = len(shard)
+                f.write(np.ascontiguousarray(shard._buffer[:count]).tobytes())
+                if shard._scales is not None:
+                    fs.write(np.ascontiguousarray(shard._scales[:count]).tobytes())
+                shard_labels = shard.labels
+            for column in REGISTER_COLUMNS:
+                labels[column].extend(str(v) for v in shard_labels[column])
+            zones.append({'zone': zone, 'offset': offset, 'count': count})
+            offset += count
+
+    sidecar = {'name': name, 'version': version, 'rows': offset, 'dim': EMBEDDING_DIM,
+               'dtype': storage, 'zones': zones, 'labels': labels}
+    with open(base + '.json' + tmp, 'w') as f:
+        json.dump(sidecar, f)
+    os.replace(base + '.bin' + tmp, base + '.bin')
+    if storage == 'int8':
+        os.replace(base + '.scales' + tmp, base + '.scales')
+    else:
+        os.remove(base + '.scales' + tmp)
+    os.replace(base + '.json' + tmp, base + '.json')
+
+    # Drop other versions of this registry's snapshot, leaving in-progress writes
+    for path in glob.glob(f"{_snapshot_base(name, directory)}.v*"):
+        match = re.match(r'\.v(\d+)\.', path[len(_snapshot_base(name, directory)):])
+        if not match or int(match.group(1)) == version or path.endswith('.tmp'):
+            continue
+        if not keep_newer or int(match.group(1)) < version:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return base
+
+def load_snapshot(name='staff:register', directory=None, home_zone=None):
+    """Memory-map the newest snapshot; returns (gallery, version) or None.
+
+    The matrix pages are mapped read-only, so worker processes on one host
+    share them through the OS page cache until a refresh writes to them.
+    """
+    directory = directory or snapshot_dir
+    sidecars = glob.glob(f"{_snapshot_base(name, directory)}.v*.json")
+    if not sidecars:
+        return None
+    path = max(sidecars, key=lambda p: int(p.rsplit('.v', 1)[1][:-len('.json')]))
+    try:
+        with open(path) as f:
+            sidecar = json.load(f)
+        if sidecar['dtype'] != gallery_storage:
+            # Storage format changed since the snapshot was written
+            return None
+        base = path[:-len('.json')]
+        shape = (sidecar['rows'], sidecar['dim'])
+        matrix = np.empty(shape, dtype=sidecar['dtype'])
+        scales = None
+        if shape[0]:
+            matrix = np.memmap(base + '.bin', dtype=sidecar['dtype'], mode='r', shape=shape)
+            if sidecar['dtype'] == 'int8':
+                scales = np.memmap(base + '.scales', dtype=np.float32, mode='r', shape=(shape[0],))
+    except Exception as e:
+        print(f"Error loading snapshot {path}: {str(e)}")
+        return None
+
+    shards = {}
+    for entry in sidecar['zones']:
+        start, stop = entry['offset'], entry['offset'] + entry['count']
+        shard_labels = {column: values[start:stop] for column, values in sidecar['labels'].items()}
+        shard_scales = None if scales is None else scales[start:stop]
+        shard = FaceGallery(matrix[start:stop], shard_labels, normalized=True,
+                            storage=sidecar['dtype'], scales=shard_scales)
+        shards[entry['zone']] = _index_gallery(shard, f"{name}@{entry['zone']}")
+    return ShardedGallery(shards, home_zone=home_zone or kiosk_zone), sidecar['version']
+
+class GalleryCache:
+    """Sharded gallery kept in sync with staff:register incrementally.
+
+    Polls the registry version counter at most every `poll_interval` seconds
+    and applies only the fields changed since the held version, so refresh
+    cost follows the number of changes rather than the registry size. After
+    changes the snapshot is rewritten at most every `snapshot_interval`
+    seconds, so processes started later map it instead of copying the
+    mapped matrix to replay them.
+    """
+    def __init__(self, name='staff:register', home_zone=None, poll_interval=2.0):
+        self.name = name
+        self.home_zone = home_zone
+        self.poll_interval = poll_interval
+        self.gallery = None
+        self.version = 0
+        self.checked_at = 0.0
+        self.snapshot_version = None
+        self.snapshot_at = 0.0
+        self._saving = False
+        self._lock = threading.Lock()
+
+    def _remote_version(self):
+        return int(r.get(register_version_key(self.name)) or 0)
+
+    def reload(self, use_snapshot=True):
+        if use_snapshot and snapshot_dir:
+            loaded = load_snapshot(name=self.name, home_zone=self.home_zone)
+            if loaded is not None:
+                # Serve from the snapshot now and reconcile with Redis off the request path
+                self.gallery, self.version = loaded
+                self.snapshot_version = self.version
+                self.checked_at = time.time()
+                threading.Thread(target=self._verify_snapshot, daemon=True).start()
+                return self.gallery
+
+        # Read the version first so changes made during the load are replayed
+        version = self._remote_version()
+        self.gallery = load_sharded_gallery(name=self.name, home_zone=self.home_zone)
+        self.version = version
+        self.checked_at = time.time()
+        if snapshot_dir:
+            try:
+                save_snapshot(self.gallery, name=self.name, version=version)
+                self.snapshot_version, self.snapshot_at = version, time.time()
+            except Exception as e:
+                print(f"Error saving snapshot: {str(e)}")
+        return self.gallery
+
+    def _verify_snapshot(self):
+        with self._lock:
+            try:
+                if self._remote_version() < self.version:
+                    # Redis was reset behind the snapshot
+                    self.reload(use_snapshot=False)
+                    return
+                self.refresh()
+                if count_register(self.name, batch_size=register_batch_size) != len(self.gallery):
+                    # Entries written without a version bump
+                    self.reload(use_snapshot=False)
+            except Exception as e:
+                print(f"Error verifying snapshot: {str(e)}")
+
+    def refresh(self):
+        """Apply registry changes since the held version; returns how many were applied"""
+        version = self._remote_version()
+        self.checked_at = time.time()
+        if version == self.version:
+            self._save_snapshot()
+            return 0
+
+        fields = r.zrangebyscore(register_changes_key(self.name), f"({self.version}", version)
+        values = r.hmget(self.name, fields) if fields else []
+        for field, value in zip(fields, values):
+            key = field.decode() if isinstance(field, bytes) else field
+            if value is None:
+                self.gallery.remove(key)
+                continue
+            try:
+                self.gallery.upsert(key, decode_embedding(value), parse_register_key(key))
+            except Exception as e:
+                print(f"Error processing record {key}: {str(e)}")
+        self.version = version
+        self._save_snapshot()
+        return len(fields)
+
+    def _save_snapshot(self):
+        # Write the held version in the background once the interval has passed
+        if not snapshot_dir or self._saving or self.snapshot_version == self.version:
+            return
+        if time.time() - self.snapshot_at < snapshot_interval:
+            return
+        self._saving = True
+        self.snapshot_at = time.time()
+        gallery, version = self.gallery, self.version
+
+        def run():
+            try:
+                save_snapshot(gallery, name=self.name, version=version, keep_newer=True)
+                self.snapshot_version = version
+            except Exception as e:
+                print(f"Error saving snapshot: {str(e)}")
+            finally:
+                self._saving = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self):
+        if self.gallery is None:
+            with self._lock:
+                if self.gallery is None:
+                    self.reload()
+        elif time.time() - self.checked_at >= self.poll_interval:
+            # One caller refreshes; the others keep matching on the current gallery
+            if self._lock.acquire(blocking=False):
+                try:
+                    self.refresh()
+                finally:
+                    self._lock.release()
+        return self.gallery
+
+@st.cache_resource
+def shared_gallery_cache(name='staff:register'):
+    """One GalleryCache per server process, shared read-only by every session and page"""
+    return GalleryCache(name=name, home_zone=kiosk_zone)
 
 def ml_search_algorithm(dataframe, feature_column, test_vector, name_role=['File No. Name', 'Role'], thresh=0.5):
+    # Fast path: a preloaded gallery skips the per-call DataFrame preparation
+    if isinstance(dataframe, (FaceGallery, ShardedGallery)):
+        return dataframe.match(test_vector, name_role=name_role, thresh=thresh)
+
+    from sklearn.metrics.pairwise import cosine_similarity
+
     dataframe = dataframe.copy()
     X_list = dataframe[feature_column].tolist()
     X_cleaned = []
@@ -101,92 +1376,285 @@ def ml_search_algorithm(dataframe, feature_column, test_vector, name_role=['File
 
     return person_name, person_role
 
+def box_iou(a, b):
+    """IoU between every box in a (n, 4) and every box in b (m, 4)"""
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+class FaceTracker:
+    """Follows faces between detections and reuses their identities.
+
+    Detection runs every `detect_every` frames; detections are tied to
+    existing tracks by IoU. Between detections boxes are moved by the
+    median Lucas-Kanade optical flow of corners inside them. Embeddings are
+    only computed for new tracks, tracks still unmatched or below
+    threshold, tracks whose detection score dropped by `score_drop`, tracks
+    whose identity is older than `refresh_every` detections, and tracks not
+    yet confirmed by `confirm_hits` embeddings. `embedded` marks the tracks
+    whose identity a new embedding checked in the current frame.
+    """
+    def __init__(self, detect_every=5, iou_thresh=0.3, max_missed=2, score_drop=0.15, refresh_every=10,
+                 confirm_hits=1, models=None):
+        self.models = models
+        self.confirm_hits = confirm_hits
+        self.detect_every = max(1, detect_every)
+        self.iou_thresh = iou_thresh
+        self.max_missed = max_missed
+        self.score_drop = score_drop
+        self.refresh_every = refresh_every
+        self.reset()
+
+    def reset(self):
+        self.tracks = []
+        self.frame_index = 0
+        self.prev_gray = None
+        self._small = None
+        self._next_id = 0
+
+    def _new_track(self, face):
+        self._next_id += 1
+        return dict(id=self._next_id, bbox=face.bbox.astype(np.float32), det_score=float(face.det_score),
+                    name='Unknown', role='Unknown', score=-1.0, missed=0, age=0,
+                    confirmations=0, embedded=False)
+
+    def _needs_embedding(self, track, face, thresh):
+        return (track['score'] < thresh
+                or track['confirmations'] < self.confirm_hits
+                or float(face.det_score) < track['det_score'] - self.score_drop
+                or track['age'] >= self.refresh_every)
+
+    def _detect(self, image, gallery, name_role, thresh):
+        faces = detect_faces(image, self.models)
+        tracks = self.tracks
+        assigned = {}
+        if tracks and faces:
+            iou = box_iou([t['bbox'] for t in tracks], [f.bbox for f in faces])
+            # Greedy matching on the highest IoU pairs
+            for flat in np.argsort(-iou, axis=None):
+                ti, fi = np.unravel_index(flat, iou.shape)
+                if iou[ti, fi] < self.iou_thresh:
+                    break
+                if ti in assigned.values() or fi in assigned:
+                    continue
+                assigned[fi] = ti
+
+        kept = []
+        to_embed = []
+        for fi, face in enumerate(faces):
+            if fi in assigned:
+                track = tracks[assigned[fi]]
+                track['age'] += 1
+                if self._needs_embedding(track, face, thresh):
+                    to_embed.append((track, face))
+                track.update(bbox=face.bbox.astype(np.float32), det_score=float(face.det_score), missed=0)
+            else:
+                track = self._new_track(face)
+                to_embed.append((track, face))
+            kept.append(track)
+
+        matched_tracks = set(assigned.values())
+        for ti, track in enumerate(tracks):
+            if ti not in matched_tracks:
+                track['missed'] += 1
+                if track['missed'] <= self.max_missed:
+                    kept.append(track)
+
+        if to_embed:
+            embed_faces(image, [face for _, face in to_embed], self.models)
+            queries = np.stack([face.embedding for _, face in to_embed])
+            matches, scores = gallery.match_batch(queries, name_role=name_role, thresh=thresh)
+            for (track, _), (name, role), score in zip(to_embed, matches, scores):
+                # Consecutive embeddings agreeing on the name confirm it
+                confirmations = track['confirmations'] + 1 if name == track['name'] else 1
+                track.update(name=name, role=role, score=float(score), age=0,
+                             confirmations=confirmations, embedded=True)
+
+        self.tracks = kept
+
+    def _follow(self, gray, scale):
+        # gray is the downscaled frame; boxes stay in full-resolution coordinates
+        h, w = gray.shape[:2]
+        for track in self.tracks:
+            x1, y1, x2, y2 = (track['bbox'] / scale).astype(int)
+            x1, y1 = max(0, x1), max(0, y1)
+            x2, y2 = min(w, x2), min(h, y2)
+            if x2 - x1 < 8 or y2 - y1 < 8:
+                continue
+            corners = cv2.goodFeaturesToTrack(self.prev_gray[y1:y2, x1:x2], maxCorners=30,
+                                              qualityLevel=0.01, minDistance=4)
+            if corners is None:
+                continue
+            corners = corners.astype(np.float32) + np.array([x1, y1], dtype=np.float32)
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, corners, None)
+            ok = status.ravel() == 1
+            if ok.any():
+                shift = np.median((moved - corners).reshape(-1, 2)[ok], axis=0) * scale
+                track['bbox'] = track['bbox'] + np.array([shift[0], shift[1], shift[0], shift[1]], dtype=np.float32)
+
+    def update(self, image, gallery, name_role=['File No. Name', 'Role'], thresh=0.5):
+        """Advance one frame; returns the current tracks"""
+        for track in self.tracks:
+            track['embedded'] = False
+        width = getattr(self.models or faceapp, 'infer_width', infer_width_default)
+        small, scale = resize_for_inference(image, width, self._small)
+        if small is not image:
+            self._small = small
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        if self.frame_index % self.detect_every == 0 or self.prev_gray is None or self.prev_gray.shape != gray.shape:
+            self._detect(image, gallery, name_role, thresh)
+        elif self.tracks:
+            self._follow(gray, scale)
+        self.prev_gray = gray
+        self.frame_index += 1
+        return self.tracks
+
+class SightingLog:
+    """Per-identity record of who was recognized since the last save.
+
+    Each name keeps its role, best score, first and last sighting and a hit
+    count, so memory is bounded by `max_identities` rather than by frames.
+    Only names with at least `min_hits` sightings, or added as `confirmed`
+    (e.g. by a tracker that already saw enough agreeing embeddings), are
+    committed, which drops one-frame false matches. When full, the weakest record (fewest hits,
+    then oldest) makes room for a new name. 'Unknown' is never recorded.
+    """
+    def __init__(self, max_identities=64, min_hits=3):
+        self.max_identities = max_identities
+        self.min_hits = min_hits
+        self._records = {}
+        # predict() adds from the pipeline worker while the callback drains
+        self._lock = threading.Lock()
+
+    def add(self, name, role, score, current_time, confirmed=False):
+        if name == 'Unknown':
+            return
+        with self._lock:
+            record = self._records.get(name)
+            if record is None:
+                if len(self._records) >= self.max_identities:
+                    weakest = min(self._records, key=lambda key: (self._records[key]['hits'], self._records[key]['last_seen']))
+                    del self._records[weakest]
+                self._records[name] = dict(role=role, score=score, first_seen=current_time,
+                                           last_seen=current_time, hits=1, confirmed=confirmed)
+                return
+            record['hits'] += 1
+            record['last_seen'] = current_time
+            record['confirmed'] = record['confirmed'] or confirmed
+            if score > record['score']:
+                record['score'] = score
+                record['role'] = role
+
+    def drain(self):
+        """Return the committed records and start over"""
+        with self._lock:
+            records, self._records = self._records, {}
+        return {name: record for name, record in records.items()
+                if record['hits'] >= self.min_hits or record['confirmed']}
+
+    def clear(self):
+        with self._lock:
+            self._records = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
 class RealTimePrediction:
-    def __init__(self):
-        self.logs = dict(name=[], role=[], current_time=[])
+    def __init__(self, tracking=False, detect_every=None, models=None):
+        self.logs = SightingLog(log_max_identities, log_min_hits)
+        self.models = models or faceapp
+        self.tracker = None
+        if tracking:
+            self.tracker = FaceTracker(detect_every=detect_every or tracking_detect_every,
+                                       confirm_hits=log_min_hits, models=self.models)
     
     def reset_dict(self):
-        self.logs = dict(name=[], role=[], current_time=[])
+        self.logs.clear()
 
     def check_last_action(self, name, current_action):
         if name == 'Unknown':
             return True
-        
-        logs = load_logs('attendance:logs', end=10)
-        last_action = None
-        last_date = None
-        
-        for log in logs:
-            if isinstance(log, bytes):
-                log = log.decode('utf-8')
-            
-            parts = log.split('@')
-            if len(parts) == 4:
-                log_name, _, log_timestamp, log_action = parts
-                if log_name == name:
-                    try:
-                        log_datetime = datetime.strptime(log_timestamp.split('.')[0], '%Y-%m-%d %H:%M:%S')
-                        log_date = log_datetime.date()
-                        
-                        if last_date is None or log_datetime > last_date:
-                            last_action = log_action
-                            last_date = log_datetime
-                    except:
-                        continue
-        
-        if last_action is None:
-            return True
-        
-        current_date = datetime.now().date()
-        same_day = (last_date.date() == current_date) if last_date else False
-        
-        if not same_day:
-            return True
-        
-        if last_action == 'Clock_In' and current_action == 'Clock_Out':
-            return True
-        elif last_action == 'Clock_Out' and current_action == 'Clock_In':
-            return True
-        elif last_action == current_action:
-            return False
-        
-        return True
+
+        # One HGET on the per-staff state, however old the last action is
+        last_action, last_date = last_attendance_action(name)
+        return action_allowed(last_action, last_date, current_action)
 
     def saveLogs_redis(self, Clock_In_Out):
-        dataframe = pd.DataFrame(self.logs)
-        dataframe.drop_duplicates('name', inplace=True)
-        name_list = dataframe['name'].tolist()
-        role_list = dataframe['role'].tolist()
-        current_time_list = dataframe['current_time'].tolist()
-        encoded_data = []
-
-        for name, role, current_time in zip(name_list, role_list, current_time_list):
-            if name != 'Unknown':
-                if self.check_last_action(name, Clock_In_Out):
-                    concat_string = f"{name}@{role}@{current_time}@{Clock_In_Out}"
-                    encoded_data.append(concat_string)
-                else:
-                    print(f"Action blocked: {name} attempted {Clock_In_Out} after previous action")
+        """Record everyone seen since the last save; returns {name: recorded}.
 
-        if len(encoded_data) > 0:
-            r.lpush('attendance:logs', *encoded_data)
+        The duplicate check, state update and log append for the whole batch
+        are one Redis round trip, so callers need no separate check first.
+        """
+        # One committed record per name, logged at its first sighting
+        entries = [(name, record['role'], record['first_seen']) for name, record in self.logs.drain().items()]
 
-        self.reset_dict()
+        results = {}
+        for (name, _, _), recorded in zip(entries, record_attendance(entries, Clock_In_Out)):
+            results[name] = recorded
+            if not recorded:
+                print(f"Action blocked: {name} attempted {Clock_In_Out} after previous action")
+        return results
 
-    def face_prediction(self, test_image, dataframe, feature_column, name_role=['File No. Name', 'Role'], thresh=0.5):
+    def predict(self, test_image, dataframe, feature_column='Facial_features', name_role=['File No. Name', 'Role'], thresh=0.5):
+        """Detect and match faces and log them; returns the predictions to draw"""
         current_time = str(datetime.now())
-        results = faceapp.get(test_image)
-        test_copy = test_image.copy()
-        
-        for res in results:
-            x1, y1, x2, y2 = res['bbox'].astype(int)
-            embeddings = res['embedding']
-            person_name, person_role = ml_search_algorithm(dataframe, 
-                                                          feature_column,
-                                                          test_vector=embeddings,
-                                                          name_role=name_role,
-                                                          thresh=thresh)
-            
+        gallery = dataframe
+        if not isinstance(gallery, (FaceGallery, ShardedGallery)):
+            gallery = FaceGallery.from_dataframe(dataframe, feature_column)
+
+        if self.tracker is not None:
+            return self._predict_tracked(test_image, gallery, name_role, thresh, current_time)
+
+        results = self.models.get(test_image)
+        if not results:
+            return []
+
+        # Match every face in the frame with a single (k, 512) query
+        queries = np.stack([res['embedding'] for res in results])
+        matches, scores = gallery.match_batch(queries, name_role=name_role, thresh=thresh)
+
+        predictions = []
+        for res, (person_name, person_role), score in zip(results, matches, scores):
+            predictions.append(dict(bbox=res['bbox'].astype(int), name=person_name, role=person_role,
+                                    score=float(score), current_time=current_time))
+
+            self.logs.add(person_name, person_role, float(score), current_time)
+
+        return predictions
+
+    def _predict_tracked(self, test_image, gallery, name_role, thresh, current_time):
+        predictions = []
+        for track in self.tracker.update(test_image, gallery, name_role=name_role, thresh=thresh):
+            if track['missed']:
+                continue
+            predictions.append(dict(bbox=track['bbox'].astype(int), name=track['name'], role=track['role'],
+                                    score=track['score'], current_time=current_time))
+
+            # A fresh embedding counts as a sighting; followed frames only count once
+            # enough embeddings agreed on the name, which holds across saves
+            confirmed = track['confirmations'] >= self.tracker.confirm_hits
+            if track['embedded'] or confirmed:
+                self.logs.add(track['name'], track['role'], track['score'], current_time, confirmed=confirmed)
+
+        return predictions
+
+    def draw_predictions(self, test_image, predictions, in_place=False):
+        # in_place draws straight onto test_image, e.g. a frame view the caller owns
+        test_copy = test_image if in_place else test_image.copy()
+
+        for prediction in predictions or []:
+            x1, y1, x2, y2 = prediction['bbox']
+            person_name = prediction['name']
+            current_time = prediction['current_time']
+
             if person_name == 'Unknown':
                 color = (0, 0, 255)  # Red for unknown
             else:
@@ -196,44 +1664,273 @@ class RealTimePrediction:
             text_gen = person_name
             cv2.putText(test_copy, text_gen, (x1, y1), cv2.FONT_HERSHEY_DUPLEX, 0.7, color, 2)
             cv2.putText(test_copy, current_time, (x1, y2+10), cv2.FONT_HERSHEY_DUPLEX, 0.7, color, 2)
-
-            self.logs['name'].append(person_name)
-            self.logs['role'].append(person_role)
-            self.logs['current_time'].append(current_time)
         
         return test_copy
 
+    def face_prediction(self, test_image, dataframe, feature_column, name_role=['File No. Name', 'Role'], thresh=0.5, in_place=False):
+        predictions = self.predict(test_image, dataframe, feature_column, name_role=name_role, thresh=thresh)
+        return self.draw_predictions(test_image, predictions, in_place=in_place)
+
+def bgr_frame_view(frame):
+    """Returns (bgr_frame, image) for an av.VideoFrame without copying pixels.
+
+    `image` is a writable (h, w, 3) view of the bgr24 frame's plane, so
+    annotations drawn on it show up in `bgr_frame`, which the callback can
+    return as is. Row padding of the plane is skipped by the view.
+    """
+    bgr = frame if frame.format.name == 'bgr24' else frame.reformat(format='bgr24')
+    plane = bgr.planes[0]
+    rows = np.frombuffer(plane, dtype=np.uint8).reshape(bgr.height, plane.line_size)
+    return bgr, rows[:, :bgr.width * 3].reshape(bgr.height, bgr.width, 3)
+
+class FramePipeline:
+    """Runs recognition on a worker thread, off the WebRTC frame callback.
+
+    `submit` copies the newest frame into a preallocated pending buffer,
+    replacing any frame the worker has not started yet; the worker swaps it
+    with its own buffer, so no frame memory is allocated per frame and the
+    callback may draw on its frame right after submitting. Recognition runs
+    as fast as the CPU allows while the callback keeps camera frame rate by
+    drawing `latest()`. The worker exits after `idle_timeout` seconds
+    without frames and restarts on the next submit, so page reruns do not
+    leak threads.
+    """
+    def __init__(self, process, idle_timeout=5.0):
+        self.process = process
+        self.idle_timeout = idle_timeout
+        self._pending = None
+        self._working = None
+        self._has_pending = False
+        self._result = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+
+    def submit(self, frame):
+        with self._lock:
+            if self._pending is None or self._pending.shape != frame.shape:
+                self._pending = np.empty_like(frame)
+            # Latest frame wins: overwrite the stale one still waiting
+            np.copyto(self._pending, frame)
+            self._has_pending = True
+            self._ready.notify()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def latest(self):
+        return self._result
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._has_pending:
+                    if not self._ready.wait(timeout=self.idle_timeout) and not self._has_pending:
+                        self._thread = None
+                        return
+                # Submit only ever writes the pending buffer
+                self._pending, self._working = self._working, self._pending
+                self._has_pending = False
+                frame = self._working
+            try:
+                self._result = self.process(frame)
+            except Exception as e:
+                print(f"Error processing frame: {str(e)}")
+
+def face_quality(image, face):
+    """Sample quality in [0, 1]: geometric mean of detection score, size,
+    frontal pose from the five keypoints and sharpness of the face crop"""
+    x1, y1, x2, y2 = face.bbox
+    # Faces at least as large as the 112 px recognition input score 1
+    size = min(1.0, min(x2 - x1, y2 - y1) / 112.0)
+
+    pose = 1.0
+    if face.kps is not None:
+        kps = np.asarray(face.kps, dtype=np.float32)
+        eyes = (kps[0] + kps[1]) / 2
+        axis = kps[1] - kps[0]
+        eye_dist = max(float(np.linalg.norm(axis)), 1e-6)
+        # Undo in-plane roll (alignment removes it anyway) and measure in eye distances
+        cos, sin = axis / eye_dist
+        local = (kps - eyes) @ np.array([[cos, -sin], [sin, cos]], dtype=np.float32) / eye_dist
+        mouth_y = max(float(local[3, 1] + local[4, 1]) / 2, 1e-6)
+        # A frontal nose sits between the eyes, halfway down to the mouth
+        yaw = abs(float(local[2, 0]))
+        pitch = abs(float(local[2, 1]) / mouth_y - 0.5)
+        pose = max(0.0, 1 - yaw / 0.5) * max(0.0, 1 - pitch / 0.4)
+
+    h, w = image.shape[:2]
+    crop = image[max(0, int(y1)):min(h, int(y2)), max(0, int(x1)):min(w, int(x2))]
+    sharpness = 0.0
+    if crop.size:
+        gray = cv2.cvtColor(cv2.resize(crop, (64, 64), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        variance = float(cv2.Laplacian(gray, cv2.CV_32F).var())
+        sharpness = variance / (variance + 100.0)
+
+    parts = np.clip([float(face.det_score), size, pose, sharpness], 0.0, 1.0)
+    return float(np.prod(parts) ** 0.25)
+
+class EmbeddingRing:
+    """Fixed-capacity buffer of the latest embeddings with a running mean.
+
+    Replaces the per-frame text files of the verification pages: appends
+    write into a preallocated float32 array, and the sum of the rows held
+    is updated as old rows are overwritten, so `mean()` costs O(dim).
+    """
+    def __init__(self, capacity=64, dim=EMBEDDING_DIM):
+        self.capacity = capacity
+        self._buffer = np.zeros((capacity, dim), dtype=np.float32)
+        self._sum = np.zeros(dim, dtype=np.float64)
+        self._count = 0
+        self._next = 0
+        # Appends come from the video thread, reads from the script thread
+        self._lock = threading.Lock()
+
+    def append(self, embedding):
+        """Write into the next row, overwriting the oldest once full; returns the row"""
+        with self._lock:
+            slot = self._next
+            self._write(slot, embedding, self._count == self.capacity)
+            if self._count < self.capacity:
+                self._count += 1
+            self._next = (self._next + 1) % self.capacity
+            return slot
+
+    def replace(self, slot, embedding):
+        """Overwrite a row already held"""
+        with self._lock:
+            self._write(slot, embedding, True)
+
+    def _write(self, slot, embedding, held):
+        row = self._buffer[slot]
+        if held:
+            self._sum -= row
+        row[:] = embedding
+        self._sum += row
+
+    def mean(self):
+        """Mean of the embeddings held, or None when empty"""
+        with self._lock:
+            if self._count == 0:
+                return None
+            return (self._sum / self._count).astype(np.float32)
+
+    def clear(self):
+        with self._lock:
+            self._sum[:] = 0
+            self._count = 0
+            self._next = 0
+
+    def __len__(self):
+        return self._count
+
+class SampleSelector:
+    """Keeps the `k` best embeddings by face quality in an EmbeddingRing.
+
+    Faces below `min_quality` are never kept. The ring fills in arrival
+    order; once full, the worst sample's row is replaced by any better one,
+    so the running mean stays O(dim). When every kept sample reaches
+    `target_quality` the selector is `done` and capture can stop.
+    """
+    def __init__(self, k=10, min_quality=0.5, target_quality=0.7, dim=EMBEDDING_DIM):
+        self.k = k
+        self.min_quality = min_quality
+        self.target_quality = target_quality
+        self.ring = EmbeddingRing(k, dim)
+        self._scores = np.full(k, -np.inf, dtype=np.float32)
+        self._count = 0
+        # Offers come from the video thread, reads from the script thread
+        self._lock = threading.Lock()
+
+    def wants(self, quality):
+        """Whether a face of this quality would be kept; checked before embedding it"""
+        if quality < self.min_quality:
+            return False
+        return self._count < self.k or quality > float(self._scores.min())
+
+    def offer(self, embedding, quality):
+        with self._lock:
+            if not self.wants(quality):
+                return False
+            if self._count < self.k:
+                slot = self.ring.append(embedding)
+                self._count += 1
+            else:
+                slot = int(np.argmin(self._scores))
+                self.ring.replace(slot, embedding)
+            self._scores[slot] = quality
+            return True
+
+    @property
+    def done(self):
+        return self._count == self.k and float(self._scores.min()) >= self.target_quality
+
+    def mean(self):
+        """Mean of the kept embeddings, or None when nothing was kept"""
+        return self.ring.mean()
+
+    def clear(self):
+        with self._lock:
+            self.ring.clear()
+            self._scores[:] = -np.inf
+            self._count = 0
+
+    def __len__(self):
+        return self._count
+
+def capture_sample(frame, selector, annotate=True, models=None):
+    """Offer the best face in frame to selector; returns its embedding when kept.
+
+    Only that face is embedded, and only if the selector would keep it;
+    nothing runs once the selector is done.
+    """
+    if selector.done:
+        if annotate:
+            cv2.putText(frame, f"samples = {len(selector)} (complete)", (10, 30),
+                        cv2.FONT_HERSHEY_DUPLEX, 0.6, (0, 255, 0), 2)
+        return None
+
+    faces = detect_faces(frame, models)
+    if not faces:
+        return None
+
+    quality, face = max(((face_quality(frame, face), face) for face in faces), key=lambda item: item[0])
+    embedding = None
+    if selector.wants(quality):
+        embed_faces(frame, [face], models)
+        if selector.offer(face.embedding, quality):
+            embedding = face.embedding
+
+    if annotate:
+        # Clamp coordinates to frame dimensions
+        h, w = frame.shape[:2]
+        x1, y1, x2, y2 = face.bbox.astype(int)
+        x1, y1 = max(0, x1), max(0, y1)
+        x2, y2 = min(w - 1, x2), min(h - 1, y2)
+
+        # Blue box when the face was kept, red when it did not pass the quality gate
+        color = (255, 0, 0) if embedding is not None else (0, 0, 255)
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        text = f"samples = {len(selector)}/{selector.k} q={quality:.2f}"
+        cv2.putText(frame, text, (x1, y1 - 10),
+                    cv2.FONT_HERSHEY_DUPLEX, 0.6, (255, 255, 0), 2)
+
+    return embedding
+
 class RegistrationForm:
     def __init__(self):
+        self.samples = SampleSelector(register_samples, quality_min, quality_target)
         self.sample = 0
 
     def reset(self):
         self.sample = 0
+        self.samples.clear()
 
-    def get_embedding(self, frame):
-        results = faceapp.get(frame)
-        embeddings = None
-        
-        if results:
-            for res in results:
-                self.sample += 1
-                x1, y1, x2, y2 = res['bbox'].astype(int)
-                
-                # Clamp coordinates to frame dimensions
-                h, w = frame.shape[:2]
-                x1, y1 = max(0, x1), max(0, y1)
-                x2, y2 = min(w - 1, x2), min(h - 1, y2)
-                
-                # Draw blue box (BGR: (255, 0, 0))
-                cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 2)
-                
-                # Draw text above the box
-                text = f"samples = {self.sample}"
-                cv2.putText(frame, text, (x1, y1 - 10), 
-                        cv2.FONT_HERSHEY_DUPLEX, 0.6, (255, 255, 0), 2)
-                
-                embeddings = res['embedding']
-        
+    def get_embedding(self, frame, annotate=True):
+        """Returns the frame and the embedding of the face kept from it, if any"""
+        embeddings = capture_sample(frame, self.samples, annotate)
+        if embeddings is not None:
+            self.sample += 1
         return frame, embeddings
     
     def save_data_in_redis_db(self, file_number, first_name, last_name, role, zone='Lagos Zone 2'):
@@ -245,25 +1942,32 @@ class RegistrationForm:
         else:
             return 'false file number'
         
-        if 'face_embedding.txt' not in os.listdir():
-            return 'No face_embedding.txt'
+        # Prefer the quality-selected samples; face_embedding.txt is the older capture path
+        x_mean = self.samples.mean()
+        if x_mean is None:
+            if 'face_embedding.txt' not in os.listdir():
+                return 'No face_embedding.txt'
 
-        # load face_embedding.txt and convert into array
-        x_array = np.loadtxt('face_embedding.txt', dtype=np.float32)
+            # load face_embedding.txt and convert into array
+            x_array = np.loadtxt('face_embedding.txt', dtype=np.float32)
 
-        received_samples = int(x_array.size/512)
-        x_array = x_array.reshape(received_samples,512)
-        x_array = np.asarray(x_array)
+            received_samples = int(x_array.size/512)
+            x_array = x_array.reshape(received_samples,512)
+            x_array = np.asarray(x_array)
 
-        # calc. the mean embeddings
-        x_mean = x_array.mean(axis=0)
+            # calc. the mean embeddings
+            x_mean = x_array.mean(axis=0)
         x_mean = x_mean.astype(np.float32)
-        x_mean_bytes = x_mean.tobytes()
+        x_mean_bytes = encode_embedding(x_mean)
 
-        # save into redis database
-        r.hset(name='staff:register', key=key, value=x_mean_bytes)
+        # save into redis database and let gallery caches pick up the change
+        pipe = r.pipeline()
+        pipe.hset(name='staff:register', key=key, value=x_mean_bytes)
+        record_register_change(pipe, 'staff:register', key)
+        pipe.execute()
 
-        os.remove('face_embedding.txt')
+        if os.path.exists('face_embedding.txt'):
+            os.remove('face_embedding.txt')
         self.reset()
         
         return True
@@ -271,60 +1975,30 @@ class RegistrationForm:
 class StaffMovement:
     def __init__(self):
         self.recognizer = RealTimePrediction()
-        self.staff_df = retrive_data(name='staff:register')
+        self.gallery_cache = shared_gallery_cache(name='staff:register')
+        self.embeddings = SampleSelector(min(verify_top_k, verify_samples), quality_min, quality_target)
         self.sample = 0
     
     def reset(self):
         self.sample = 0
-        if os.path.exists('movement_embedding.txt'):
-            os.remove('movement_embedding.txt')
+        self.embeddings.clear()
 
-    def get_embedding(self, frame):
-        results = faceapp.get(frame)
-        reg_img = frame.copy()
-        embeddings = None
-        
-        if results:
-            for res in results:
-                self.sample += 1
-                x1, y1, x2, y2 = res['bbox'].astype(int)
-                
-                # Clamp coordinates to frame dimensions
-                h, w = frame.shape[:2]
-                x1, y1 = max(0, x1), max(0, y1)
-                x2, y2 = min(w - 1, x2), min(h - 1, y2)
-                
-                # Draw blue box (BGR: (255, 0, 0))
-                cv2.rectangle(reg_img, (x1, y1), (x2, y2), (255, 0, 0), 2)
-                
-                # Draw text above the box
-                text = f"samples = {self.sample}"
-                cv2.putText(reg_img, text, (x1, y1 - 10), 
-                        cv2.FONT_HERSHEY_DUPLEX, 0.6, (255, 255, 0), 2)
-                
-                embeddings = res['embedding']
-        
-        # Save embedding to file if exists
-        if embeddings is not None:
-            with open('movement_embedding.txt', mode='ab') as f:
-                np.savetxt(f, embeddings)
-        
-        return reg_img
+    def get_embedding(self, frame, annotate=True):
+        """Capture quality-selected face embeddings for verification; annotates frame in place"""
+        if capture_sample(frame, self.embeddings, annotate) is not None:
+            self.sample += 1
+        return frame
 
     def save_movement_data(self, movement_type, purpose, location, note):
         """Save movement data after face verification"""
         # Check if face data exists
-        if not os.path.exists('movement_embedding.txt'):
+        x_mean = self.embeddings.mean()
+        if x_mean is None:
             return 'No face embedding found'
         
-        # Load and process embeddings
-        x_array = np.loadtxt('movement_embedding.txt', dtype=np.float32)
-        x_array = x_array.reshape(-1, 512)
-        x_mean = x_array.mean(axis=0)
-        
         # Verify staff
         person_name, person_role = ml_search_algorithm(
-            self.staff_df,
+            self.gallery_cache.get(),
             'Facial_features',
             test_vector=x_mean,
             thresh=0.5
@@ -347,61 +2021,30 @@ class StaffMovement:
 class StaffDutyReport:
     def __init__(self):
         self.recognizer = RealTimePrediction()
-        self.staff_df = retrive_data(name='staff:register')
+        self.gallery_cache = shared_gallery_cache(name='staff:register')
+        self.embeddings = SampleSelector(min(verify_top_k, verify_samples), quality_min, quality_target)
         self.sample = 0
     
     def reset(self):
         self.sample = 0
-        if os.path.exists('duty_report_embedding.txt'):
-            os.remove('duty_report_embedding.txt')
-
-    def get_embedding(self, frame):
-        """Capture face embeddings for verification"""
-        results = faceapp.get(frame)
-        reg_img = frame.copy()
-        embeddings = None
-        
-        if results:
-            for res in results:
-                self.sample += 1
-                x1, y1, x2, y2 = res['bbox'].astype(int)
-                
-                # Clamp coordinates to frame dimensions
-                h, w = frame.shape[:2]
-                x1, y1 = max(0, x1), max(0, y1)
-                x2, y2 = min(w - 1, x2), min(h - 1, y2)
-                
-                # Draw blue box
-                cv2.rectangle(reg_img, (x1, y1), (x2, y2), (255, 0, 0), 2)
-                
-                # Draw text above the box
-                text = f"samples = {self.sample}"
-                cv2.putText(reg_img, text, (x1, y1 - 10), 
-                          cv2.FONT_HERSHEY_DUPLEX, 0.6, (255, 255, 0), 2)
-                
-                embeddings = res['embedding']
-        
-        # Save embedding to file if exists
-        if embeddings is not None:
-            with open('duty_report_embedding.txt', mode='ab') as f:
-                np.savetxt(f, embeddings)
-        
-        return reg_img
+        self.embeddings.clear()
+
+    def get_embedding(self, frame, annotate=True):
+        """Capture quality-selected face embeddings for verification; annotates frame in place"""
+        if capture_sample(frame, self.embeddings, annotate) is not None:
+            self.sample += 1
+        return frame
 
     def save_duty_report(self, report_data):
         """Save the complete duty report with verification"""
         # Verify signer's identity
-        if not os.path.exists('duty_report_embedding.txt'):
+        x_mean = self.embeddings.mean()
+        if x_mean is None:
             return 'No face verification found'
         
-        # Load and process embeddings
-        x_array = np.loadtxt('duty_report_embedding.txt', dtype=np.float32)
-        x_array = x_array.reshape(-1, 512)
-        x_mean = x_array.mean(axis=0)
-        
         # Verify staff
         signer_name, signer_role = ml_search_algorithm(
-            self.staff_df,
+            self.gallery_cache.get(),
             'Facial_features',
             test_vector=x_mean,
             thresh=0.5
@@ -433,9 +2076,11 @@ def migrate_redis_data():
         if key_str.count('@') == 1:  # Old format without zone
             # Add default zone
             new_key = f"{key_str}@Lagos Zone 2"
-            # Update Redis with new key
-            r.hset('staff:register', new_key, value)
-            # Remove old key
-            r.hdel('staff:register', key)
+            # Update Redis with new key and remove old key
+            pipe = r.pipeline()
+            pipe.hset('staff:register', new_key, value)
+            pipe.hdel('staff:register', key)
+            record_register_change(pipe, 'staff:register', new_key, key_str)
+            pipe.execute()
     
     return "Migration completed successfully"
\ No newline at end of file
@@ -0,0 +1,251 @@
+"""Local face inference service shared by every kiosk session.
+
+Run it next to the Streamlit server, from the same directory so it reads the
+same secrets, and point the INFERENCE_SOCKET secret at the same path:
+
+    python inference_server.py --socket /tmp/staffsuite-inference.sock --workers 4
+
+Requests are pickled, so both sides must present the INFERENCE_AUTHKEY
+secret, and the socket is created owner-only (0600).
+
+The parent process binds one Unix socket and forks a pool of worker
+processes that all accept connections on it. Each worker owns its own face
+models (no gallery), so inference runs outside the Streamlit process and
+its GIL, and the pool scales to the number of CPUs. A page holds one
+connection per session and sends frames, or only the aligned face crops
+when faces are already detected, along with its model configuration;
+replies carry boxes, keypoints and embeddings, and matching stays on the
+page's gallery.
+"""
+import argparse
+import multiprocessing
+import os
+import stat
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+
+def _faces_to_dicts(faces):
+    return [dict(bbox=np.asarray(face.bbox, dtype=np.float32),
+                 kps=None if face.kps is None else np.asarray(face.kps, dtype=np.float32),
+                 det_score=float(face.det_score),
+                 embedding=None if face.get('embedding') is None else np.asarray(face.embedding, dtype=np.float32))
+            for face in faces]
+
+
+def _dicts_to_faces(items):
+    from insightface.app.common import Face
+
+    faces = []
+    for item in items:
+        face = Face(bbox=item['bbox'], kps=item['kps'], det_score=item['det_score'])
+        if item.get('embedding') is not None:
+            face.embedding = item['embedding']
+        faces.append(face)
+    return faces
+
+
+class _Worker:
+    """Request handlers for one worker process"""
+
+    def __init__(self):
+        import face_utils
+
+        self.face_utils = face_utils
+        self.models = {}
+        self._lock = threading.Lock()
+
+    def _models(self, config):
+        # One FaceModels per page configuration (see load_face_models)
+        key = repr(sorted(config.items()))
+        with self._lock:
+            if key not in self.models:
+                self.models[key] = self.face_utils.load_face_models(local=True, **config)
+            return self.models[key]
+
+    def ping(self):
+        return os.getpid()
+
+    def detect(self, image, config):
+        return _faces_to_dicts(self._models(config).detect(image))
+
+    def embed(self, crops, config):
+        if not crops:
+            return np.empty((0, 512), dtype=np.float32)
+        return np.asarray(self._models(config).embedder.embed_crops(crops), dtype=np.float32).reshape(len(crops), -1)
+
+    def get(self, image, config):
+        return _faces_to_dicts(self._models(config).get(image))
+
+
+def _serve_connection(worker, conn):
+    with conn:
+        while True:
+            try:
+                op, kwargs = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                reply = ('ok', getattr(worker, op)(**kwargs))
+            except Exception as e:
+                reply = ('error', f"{type(e).__name__}: {str(e)}")
+            try:
+                conn.send(reply)
+            except (EOFError, OSError):
+                return
+
+
+def _serve(listener):
+    worker = _Worker()
+    while True:
+        try:
+            conn = listener.accept()
+        except (AuthenticationError, EOFError, OSError) as e:
+            print(f"Rejected inference connection: {str(e)}")
+            continue
+        threading.Thread(target=_serve_connection, args=(worker, conn), daemon=True).start()
+
+
+def serve(address, workers=None, authkey=None):
+    if not authkey:
+        raise ValueError("INFERENCE_AUTHKEY must be set to run the inference server")
+    if os.path.lexists(address):
+        # Only replace a stale socket of ours, never another file
+        info = os.lstat(address)
+        if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+            raise FileExistsError(f"{address} exists and is not this user's socket")
+        os.remove(address)
+    # Bind with an owner-only mode so no other user can connect, even briefly
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(address, family='AF_UNIX', authkey=authkey.encode())
+    finally:
+        os.umask(umask)
+    # Workers inherit the bound socket, so they must be forked
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_serve, args=(listener,), daemon=True)
+                 for _ in range(workers or os.cpu_count() or 1)]
+    for process in processes:
+        process.start()
+    print(f"Inference server on {address} with {len(processes)} workers")
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        listener.close()
+
+
+# Servers already warmed up from this process
+_warmed = set()
+_warmed_lock = threading.Lock()
+
+
+class RemoteFaceModels:
+    """Client for the inference server with the FaceModels interface.
+
+    Every calling thread (one per session or frame pipeline) gets its own
+    connection, so sessions sharing one instance never queue behind each
+    other. When the server cannot be reached, or rejects `authkey`, the calls
+    go to `fallback` (local models) instead, and connecting is retried after
+    `retry_after` seconds. The model arguments match load_face_models and
+    are sent with every request, so the server runs the page's configuration.
+    """
+
+    def __init__(self, address, authkey, det_size=None, det_thresh=0.5, detector_options=None,
+                 embedder_options=None, infer_width=None, min_face_size=None, fallback=None, retry_after=30.0):
+        self.address = address
+        self.authkey = authkey.encode()
+        self.det_size = det_size
+        self.infer_width = infer_width
+        self.config = dict(det_size=None if det_size is None else tuple(det_size), det_thresh=det_thresh,
+                           detector_options=detector_options, embedder_options=embedder_options,
+                           infer_width=infer_width, min_face_size=min_face_size)
+        self.fallback = fallback
+        self.retry_after = retry_after
+        self._local = threading.local()
+        self._failed_at = None
+
+    def _call(self, op, **kwargs):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self._failed_at is not None and time.time() - self._failed_at < self.retry_after:
+                return None
+            try:
+                conn = self._local.conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+            except (AuthenticationError, EOFError, OSError) as e:
+                print(f"Inference server unavailable at {self.address}: {str(e)}")
+                self._failed_at = time.time()
+                return None
+        try:
+            conn.send((op, kwargs))
+            status, result = conn.recv()
+        except (EOFError, OSError) as e:
+            print(f"Inference server connection lost: {str(e)}")
+            self._local.conn = None
+            self._failed_at = time.time()
+            return None
+        if status != 'ok':
+            raise RuntimeError(result)
+        return result
+
+    def detect(self, image):
+        result = self._call('detect', image=image, config=self.config)
+        if result is None and self.fallback is not None:
+            return self.fallback.detect(image)
+        return _dicts_to_faces(result or [])
+
+    detector = detect
+
+    def embedder(self, image, faces):
+        from insightface.utils import face_align
+
+        if not faces:
+            return faces
+        # Align here and send only the crops (ArcFace input is 112x112), not the frame
+        crops = [face_align.norm_crop(image, landmark=face.kps, image_size=112) for face in faces]
+        result = self._call('embed', crops=crops, config=self.config)
+        if result is None and self.fallback is not None:
+            return self.fallback.embedder(image, faces)
+        for face, embedding in zip(faces, result if result is not None else []):
+            face.embedding = embedding
+        return faces
+
+    def get(self, image):
+        # Detection and recognition in one round trip
+        result = self._call('get', image=image, config=self.config)
+        if result is None and self.fallback is not None:
+            return self.fallback.get(image)
+        return _dicts_to_faces(result or [])
+
+    def warm_up(self, background=True):
+        # Once per process and server, like FaceModels.warm_up
+        key = (self.address, self.det_size)
+        with _warmed_lock:
+            if key in _warmed:
+                return None
+            _warmed.add(key)
+
+        def run():
+            if self._call('ping') is None and self.fallback is not None:
+                self.fallback.warm_up(background=False)
+
+        if not background:
+            run()
+            return None
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='StaffSuite face inference server')
+    parser.add_argument('--socket', default='/tmp/staffsuite-inference.sock')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    import face_utils
+    serve(args.socket, workers=args.workers, authkey=face_utils.inference_authkey)
@@ -1,6 +1,5 @@
 import streamlit as st
 from streamlit_webrtc import webrtc_streamer
-import av
 import time
 import cv2
 
@@ -29,45 +28,61 @@ if not access_granted:
 # Retrieve the data from Redis Database
 with st.spinner('Retrieving Data from Database ...'):
     import face_utils
-    redis_face_db = face_utils.retrive_data(name='staff:register')
+    gallery_cache = face_utils.shared_gallery_cache(name='staff:register')
+    gallery_cache.get()
+    # One-time backfill of the last-action state from the old attendance list
+    face_utils.ensure_attendance_state()
 
 waitTime = 10  # time in sec
 setTime = time.time()
-realtimepred = face_utils.RealTimePrediction()
+# Kiosk faces are large and close, so a smaller detector input is enough
+kiosk_models = face_utils.load_face_models(det_size=(320, 320))
+kiosk_models.warm_up()
+realtimepred = face_utils.RealTimePrediction(tracking=True, models=kiosk_models)
 last_action_status = None
 
-def video_frame_callback(frame):
-    global setTime, last_action_status
-
-    img = frame.to_ndarray(format="bgr24")
-    pred_img = realtimepred.face_prediction(
+# Detection and recognition run on a worker thread; the callback only draws
+pipeline = face_utils.FramePipeline(
+    lambda img: realtimepred.predict(
         img,
-        redis_face_db,
+        gallery_cache.get(),
         'Facial_features',
         ['File No. Name', 'Role', 'Zone'],  # Added Zone to name_role
         thresh=0.5
     )
+)
+
+def video_frame_callback(frame):
+    global setTime, last_action_status
+
+    # Work on a view of the frame's pixels; the pipeline keeps its own copy
+    bgr_frame, img = face_utils.bgr_frame_view(frame)
+    pipeline.submit(img)
 
     timenow = time.time()
     difftime = timenow - setTime
 
     if difftime >= waitTime:
-        # Check if action is allowed before saving
-        if any(realtimepred.logs['name']):
-            name = realtimepred.logs['name'][0]
-            if realtimepred.check_last_action(name, 'Clock_In'):
-                realtimepred.saveLogs_redis(Clock_In_Out='Clock_In')
-                last_action_status = "✔️ Clock-In recorded"
-            else:
-                last_action_status = "❌ Already clocked-in today"
+        # Saves the identities seen often enough this window and checks each
+        # officer's last action in the same round trip; drops the rest
+        recorded = realtimepred.saveLogs_redis(Clock_In_Out='Clock_In')
+        if any(recorded.values()):
+            last_action_status = "✔️ Clock-In recorded"
+        elif recorded:
+            last_action_status = "❌ Already clocked-in today"
         setTime = time.time()
 
+    if not face_utils.annotate_frames:
+        return frame
+
+    realtimepred.draw_predictions(img, pipeline.latest(), in_place=True)
+
     # Add status text to the frame if available
     if last_action_status:
-        cv2.putText(pred_img, last_action_status, (10, 30), 
+        cv2.putText(img, last_action_status, (10, 30), 
                 cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
 
-    return av.VideoFrame.from_ndarray(pred_img, format="bgr24")
+    return bgr_frame
 
 webrtc_streamer(key="realtimePrediction", video_frame_callback=video_frame_callback,
 rtc_configuration={
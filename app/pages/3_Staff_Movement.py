@@ -1,6 +1,5 @@
 import streamlit as st
 from streamlit_webrtc import webrtc_streamer
-import av
 import sys
 import os
 sys.path.append(os.path.dirname(__file__))
@@ -27,11 +26,17 @@ def main():
     if not access_granted:
         st.error(f"Access Denied: Invalid {reason}")
         st.stop()
+
+    # Load the face models in the background while the form renders
+    face_utils.faceapp.warm_up()
         
     # Rest of your app content would go here
     
     # Initialize StaffMovement
-    staff_movement = face_utils.StaffMovement()
+    # Kept per session so the captured embeddings survive reruns
+    if 'staff_movement' not in st.session_state:
+        st.session_state.staff_movement = face_utils.StaffMovement()
+    staff_movement = st.session_state.staff_movement
 
     # Form layout
     col1, col2 = st.columns(2)
@@ -60,9 +65,9 @@ def main():
 
     # Face verification
     def video_callback_func(frame):
-        img = frame.to_ndarray(format="bgr24")
-        reg_img = staff_movement.get_embedding(img)
-        return av.VideoFrame.from_ndarray(reg_img, format="bgr24")
+        bgr_frame, img = face_utils.bgr_frame_view(frame)
+        staff_movement.get_embedding(img, annotate=face_utils.annotate_frames)
+        return bgr_frame if face_utils.annotate_frames else frame
 
     webrtc_streamer(
         key="movement_verification",
@@ -1,6 +1,5 @@
 import streamlit as st
 from streamlit_webrtc import webrtc_streamer
-import av
 import sys
 import os
 sys.path.append(os.path.dirname(__file__))
@@ -28,9 +27,15 @@ def main():
     if not access_granted:
         st.error(f"Access Denied: Invalid {reason}")
         st.stop()
+
+    # Load the face models in the background while the form renders
+    face_utils.faceapp.warm_up()
     
     # Initialize StaffDutyReport
-    duty_report = face_utils.StaffDutyReport()
+    # Kept per session so the captured embeddings survive reruns
+    if 'duty_report' not in st.session_state:
+        st.session_state.duty_report = face_utils.StaffDutyReport()
+    duty_report = st.session_state.duty_report
 
     # Form layout
     col1, col2 = st.columns(2)
@@ -87,9 +92,9 @@ def main():
     st.subheader("Face Verification for Submission")
     
     def video_callback_func(frame):
-        img = frame.to_ndarray(format="bgr24")
-        reg_img = duty_report.get_embedding(img)
-        return av.VideoFrame.from_ndarray(reg_img, format="bgr24")
+        bgr_frame, img = face_utils.bgr_frame_view(frame)
+        duty_report.get_embedding(img, annotate=face_utils.annotate_frames)
+        return bgr_frame if face_utils.annotate_frames else frame
     
     webrtc_streamer(
         key="duty_report_verification",